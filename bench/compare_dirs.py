@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from statistics import median
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import compare
+from generate_tree import generate_tree, add_tree_arguments, tree_options
+
+# the phases of compare.py --profile, summed over all workers with --jobs
+PHASES = list(compare.Profiler.PHASES)
+
+def run_once(tree_root, output_dir, compare_options):
+    """Compare `tree_root`/a with `tree_root`/b in this (fresh) process and return its measurements."""
+    output_file = os.path.join(output_dir, f"report.{compare_options.get('output_format', 'html')}")
+    st = time.perf_counter()
+    stats = compare.compare_dirs(os.path.join(tree_root, 'a'), os.path.join(tree_root, 'b'), output_file, profile=True, **compare_options)
+    elapsed = time.perf_counter() - st
+    # ru_maxrss is in KiB on Linux, the process pool workers of --jobs count as children
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    with open(os.path.join(output_dir, 'report.profile.json')) as f:
+        profile = json.load(f)
+    return {
+        'seconds': elapsed,
+        'phases': profile['phase_seconds'],
+        'bytes_read': profile['bytes_read'],
+        'peak_rss_bytes': peak_rss,
+        'report_bytes': os.path.getsize(output_file),
+        'stats': stats,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def summarize(runs, tree_summary):
+    seconds = median(run['seconds'] for run in runs)
+    summary = {
+        'seconds': seconds,
+        'files_per_second': tree_summary['files'] / seconds,
+        'megabytes_per_second': tree_summary['bytes'] / seconds / 1e6,
+        'peak_rss_bytes': max(run['peak_rss_bytes'] for run in runs),
+        'bytes_read': median(run['bytes_read'] for run in runs),
+        'phases': {phase: median(run['phases'][phase] for run in runs) for phase in PHASES},
+    }
+    return summary
+
+def print_summary(summary, baseline=None):
+    print(f"{'':>10} {'seconds':>10} {'baseline':>10} {'ratio':>7}")
+    rows = [('total', summary['seconds'], baseline and baseline['seconds'])]
+    for phase, seconds in summary.get('phases', {}).items():
+        rows.append((phase, seconds, baseline and baseline.get('phases', {}).get(phase)))
+    for name, seconds, baseline_seconds in rows:
+        if baseline_seconds:
+            print(f"{name:>10} {seconds:>10.3f} {baseline_seconds:>10.3f} {seconds / baseline_seconds:>6.2f}x")
+        else:
+            print(f"{name:>10} {seconds:>10.3f}")
+    print(f"{summary['files_per_second']:.0f} files/s, {summary['megabytes_per_second']:.1f} MB/s, {compare.sizeof_fmt(summary['bytes_read'])} read, peak RSS {summary['peak_rss_bytes'] / 2**20:.1f} MiB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark compare_dirs phase by phase on a generated tree and record the results as JSON.')
+    add_tree_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the median is reported (default: 3).')
+    parser.add_argument('--jobs', type=int, default=1, help='compare.py --jobs, the phase times are then summed over the workers (default: 1).')
+    parser.add_argument('--diff-algorithm', choices=compare.DIFF_MATCHERS.keys(), default='difflib')
+    parser.add_argument('--report-mode', choices=['inline', 'sharded'], default='inline')
+    parser.add_argument('--format', dest='output_format', choices=['html', 'ndjson', 'json'], default='html')
+    parser.add_argument('--tree-dir', help='Generate the tree here and keep it for later runs, reused if it already exists (default: a temporary directory).')
+    parser.add_argument('--output', default='bench_compare_dirs.json', help='JSON file to write the results to (default: bench_compare_dirs.json).')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare the timings with.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_compare_dirs_')
+    try:
+        tree_root = args.tree_dir or os.path.join(work_dir, 'tree')
+        summary_file = os.path.join(tree_root, 'tree.json')
+        if os.path.exists(summary_file):
+            with open(summary_file) as f:
+                tree = json.load(f)
+            if tree['options'] != tree_options(args):
+                parser.error(f'{tree_root} was generated with different options')
+        else:
+            tree = {'options': tree_options(args), 'summary': generate_tree(tree_root, **tree_options(args))}
+            with open(summary_file, 'w') as f:
+                json.dump(tree, f)
+
+        compare_options = {'jobs': args.jobs, 'diff_algorithm': args.diff_algorithm, 'report_mode': args.report_mode, 'output_format': args.output_format}
+        runs = []
+        for i in range(args.repeat):
+            output_dir = os.path.join(work_dir, f'run{i}')
+            os.makedirs(output_dir)
+            # a fresh process per run, so the peak RSS is not carried over from earlier runs
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                runs.append(pool.submit(run_once, tree_root, output_dir, compare_options).result())
+    finally:
+        shutil.rmtree(work_dir)
+
+    result = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'tree': tree,
+        'compare_options': compare_options,
+        'runs': runs,
+        'summary': summarize(runs, tree['summary']),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['summary']
+    print_summary(result['summary'], baseline)
+    print(f'Wrote {args.output}')
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compare import DIFF_MATCHERS
+
+def generate_sql_dump(nlines, seed):
+    rnd = random.Random(seed)
+    return [f"INSERT INTO items VALUES ({i}, 'item-{rnd.randint(0, nlines)}', {rnd.random():.6f});\n" for i in range(nlines)]
+
+def generate_config(nlines, seed):
+    # few distinct lines repeated many times, the worst case for difflib's longest match search
+    rnd = random.Random(seed)
+    return [f'  "key{rnd.randint(0, 300)}": {rnd.randint(0, 3)},\n' for i in range(nlines)]
+
+GENERATORS = {
+    'sql': generate_sql_dump,
+    'config': generate_config,
+}
+
+def mutate(lines, change_ratio, seed):
+    rnd = random.Random(seed)
+    result = []
+    for line in lines:
+        r = rnd.random()
+        if r < change_ratio / 3:
+            continue
+        elif r < 2 * change_ratio / 3:
+            result.append(line.replace('item', 'changed'))
+        elif r < change_ratio:
+            result.append(line)
+            result.append(f"-- inserted {rnd.random()}\n")
+        else:
+            result.append(line)
+    return result
+
+def time_matcher(matcher, a, b, nlines=3):
+    st = time.perf_counter()
+    groups = list(matcher(None, a, b).get_grouped_opcodes(nlines))
+    return time.perf_counter() - st, len(groups)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the line diff algorithms available to compare.py --diff-algorithm.')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 100000], help='Input sizes in lines (default: 1000 10000 100000).')
+    parser.add_argument('--change-ratio', type=float, default=0.01, help='Fraction of lines deleted, replaced or followed by an insert (default: 0.01).')
+    parser.add_argument('--algorithms', nargs='+', default=list(DIFF_MATCHERS.keys()), help='Algorithms to run (default: all).')
+    parser.add_argument('--shape', choices=GENERATORS.keys(), default='sql', help='Kind of generated input (default: sql).')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'lines':>8} {'algorithm':>10} {'seconds':>10} {'hunks':>7} {'speedup':>8}")
+    for nlines in args.lines:
+        a = GENERATORS[args.shape](nlines, args.seed)
+        b = mutate(a, args.change_ratio, args.seed + 1)
+        baseline = None
+        for name in args.algorithms:
+            elapsed, hunks = time_matcher(DIFF_MATCHERS[name], a, b)
+            baseline = baseline or elapsed
+            print(f"{nlines:>8} {name:>10} {elapsed:>10.3f} {hunks:>7} {baseline / elapsed:>7.1f}x")
@@ -0,0 +1,132 @@
+import os
+import random
+import argparse
+
+# fixed mtime of every generated file, so two trees generated with the same options are identical on disk
+GENERATED_MTIME = 1700000000
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'value', 'item', 'config', 'name', 'path', 'index', 'return', 'self', 'import', 'class', 'true', 'false']
+
+def generate_text(rnd, size, long_line_length=0):
+    lines, length = [], 0
+    while length < size:
+        if long_line_length:
+            line = ' '.join(rnd.choice(WORDS) for _ in range(long_line_length // 6)) + '\n'
+        else:
+            line = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))) + f' {rnd.randint(0, 99999)}\n'
+        lines.append(line)
+        length += len(line)
+    return lines
+
+def mutate_text(rnd, lines, change_ratio=0.05):
+    result = []
+    for line in lines:
+        r = rnd.random()
+        if r < change_ratio / 3:
+            continue
+        elif r < 2 * change_ratio / 3:
+            words = line.split(' ')
+            words[rnd.randrange(len(words))] = rnd.choice(WORDS).upper()
+            result.append(' '.join(words))
+        elif r < change_ratio:
+            result.append(line)
+            result.append(f'inserted {rnd.randint(0, 99999)}\n')
+        else:
+            result.append(line)
+    return result
+
+def mutate_binary(rnd, data):
+    data = bytearray(data)
+    for _ in range(max(1, len(data) // 4096) if data else 0):
+        data[rnd.randrange(len(data))] = rnd.randrange(256)
+    return bytes(data)
+
+def write_file(file_path, data):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    os.utime(file_path, (GENERATED_MTIME, GENERATED_MTIME))
+
+def generate_tree(root, files=1000, depth=3, fanout=4, size_median=4096, size_sigma=1.0, max_size=16 * 1024 * 1024,
+                  changed=0.1, added=0.02, removed=0.02, binary_ratio=0.05, long_line_ratio=0.01, long_line_length=20000, seed=42):
+    """
+    Generate a deterministic pair of trees `root`/a and `root`/b for benchmarking compare_dirs.
+
+    File sizes follow a log-normal distribution around `size_median` bytes. `changed`,
+    `added` and `removed` are the fractions of files that differ between the trees,
+    `binary_ratio` and `long_line_ratio` the fractions of binary and long-line text files.
+    Returns a summary dict with the number of files and bytes of each kind.
+    """
+    rnd = random.Random(seed)
+    dirs = ['']
+    for level in range(depth):
+        dirs += [os.path.join(parent, f'd{level}_{i}') for parent in dirs if parent.count(os.sep) + bool(parent) == level for i in range(fanout)]
+
+    summary = {'files': files, 'bytes': 0, 'changed': 0, 'added': 0, 'removed': 0, 'identical': 0, 'binary': 0, 'long_line': 0}
+    for i in range(files):
+        relpath = os.path.join(rnd.choice(dirs), f'file{i}')
+        size = min(max_size, int(rnd.lognormvariate(0, size_sigma) * size_median))
+        kind = rnd.random()
+        if kind < binary_ratio:
+            relpath += '.dat'
+            data1 = rnd.randbytes(size)
+            summary['binary'] += 1
+        elif kind < binary_ratio + long_line_ratio:
+            relpath += '.min.js'
+            data1 = ''.join(generate_text(rnd, size, long_line_length)).encode()
+            summary['long_line'] += 1
+        else:
+            relpath += '.txt'
+            data1 = ''.join(generate_text(rnd, size)).encode()
+
+        change = rnd.random()
+        if change < added:
+            data1, data2 = None, data1
+            summary['added'] += 1
+        elif change < added + removed:
+            data2 = None
+            summary['removed'] += 1
+        elif change < added + removed + changed:
+            if relpath.endswith('.dat'):
+                data2 = mutate_binary(rnd, data1)
+            else:
+                data2 = ''.join(mutate_text(rnd, data1.decode().splitlines(True))).encode()
+            # a small or empty file can come out of the mutation unchanged
+            summary['changed' if data2 != data1 else 'identical'] += 1
+        else:
+            data2 = data1
+            summary['identical'] += 1
+
+        for side, data in (('a', data1), ('b', data2)):
+            if data is not None:
+                write_file(os.path.join(root, side, relpath), data)
+                summary['bytes'] += len(data)
+    return summary
+
+def add_tree_arguments(parser):
+    parser.add_argument('--files', type=int, default=1000, help='Number of files (default: 1000).')
+    parser.add_argument('--depth', type=int, default=3, help='Directory depth (default: 3).')
+    parser.add_argument('--fanout', type=int, default=4, help='Subdirectories per directory (default: 4).')
+    parser.add_argument('--size-median', type=int, default=4096, help='Median file size in bytes (default: 4096).')
+    parser.add_argument('--size-sigma', type=float, default=1.0, help='Sigma of the log-normal file size distribution (default: 1.0).')
+    parser.add_argument('--max-size', type=int, default=16 * 1024 * 1024, help='Largest file size in bytes (default: 16777216).')
+    parser.add_argument('--changed', type=float, default=0.1, help='Fraction of files changed between the trees (default: 0.1).')
+    parser.add_argument('--added', type=float, default=0.02, help='Fraction of files only in b (default: 0.02).')
+    parser.add_argument('--removed', type=float, default=0.02, help='Fraction of files only in a (default: 0.02).')
+    parser.add_argument('--binary-ratio', type=float, default=0.05, help='Fraction of binary files (default: 0.05).')
+    parser.add_argument('--long-line-ratio', type=float, default=0.01, help='Fraction of text files made of very long lines (default: 0.01).')
+    parser.add_argument('--long-line-length', type=int, default=20000, help='Length of those lines in characters (default: 20000).')
+    parser.add_argument('--seed', type=int, default=42)
+
+def tree_options(args):
+    return {name: getattr(args, name) for name in ('files', 'depth', 'fanout', 'size_median', 'size_sigma', 'max_size', 'changed', 'added', 'removed', 'binary_ratio', 'long_line_ratio', 'long_line_length', 'seed')}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a deterministic pair of directory trees (<root>/a and <root>/b) to benchmark compare.py on.')
+    parser.add_argument('root', help='Directory to generate the trees in, must not exist yet.')
+    add_tree_arguments(parser)
+    args = parser.parse_args()
+
+    if os.path.exists(args.root):
+        parser.error(f'{args.root} already exists')
+    print(generate_tree(args.root, **tree_options(args)))
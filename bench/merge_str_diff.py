@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import html
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compare import merge_str_diff
+
+def legacy_merge_str_diff(str, cdiff):
+    # the previous per character implementation, kept for comparison
+    result = ''
+    for i in range(len(str)):
+        if i >= len(cdiff):
+            result += html.escape(str[i])
+        elif cdiff[i] == ' ':
+            result += html.escape(str[i])
+        elif cdiff[i] == '+':
+            result += '<span style="color: white; background-color: green">' + html.escape(str[i]) + '</span>'
+        elif cdiff[i] == '-':
+            result += '<span style="color: white; background-color: red">' + html.escape(str[i]) + '</span>'
+        elif cdiff[i] == '^':
+            result += '<span style="background-color: yellow">' + html.escape(str[i]) + '</span>'
+        else:
+            result += html.escape(str[i])
+    return result
+
+def generate_line(size, seed):
+    # base64-like text with scattered runs of changed characters
+    rnd = random.Random(seed)
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/<>&'
+    line = ''.join(rnd.choice(alphabet) for _ in range(size))
+    cdiff = []
+    while len(cdiff) < size:
+        cdiff.append(rnd.choice(' +-^') * rnd.randint(1, 64) if rnd.random() < 0.3 else ' ' * rnd.randint(1, 256))
+    return line, ''.join(cdiff)[:size]
+
+def time_it(func, line, cdiff):
+    st = time.perf_counter()
+    output = func(line, cdiff)
+    return time.perf_counter() - st, len(output)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmark of merge_str_diff on long changed lines.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='Line lengths in characters (default: 10000 100000 1000000).')
+    parser.add_argument('--legacy', action='store_true', help='Also time the previous per character implementation.')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    implementations = {'run-length': merge_str_diff}
+    if args.legacy:
+        implementations['legacy'] = legacy_merge_str_diff
+
+    print(f"{'chars':>9} {'impl':>11} {'seconds':>9} {'ns/char':>8} {'html bytes':>11}")
+    for size in args.sizes:
+        line, cdiff = generate_line(size, args.seed)
+        for name, func in implementations.items():
+            elapsed, output_size = time_it(func, line, cdiff)
+            print(f"{size:>9} {name:>11} {elapsed:>9.4f} {elapsed / size * 1e9:>8.1f} {output_size:>11}")
@@ -1,15 +1,311 @@
 import os
-import filecmp
 import time
 import html
 import argparse
 import hashlib
 import csv
+import re
+import fnmatch
+import sqlite3
+import threading
+import queue
+import json
+import zlib
+import gzip
+import io
+import mmap
+import codecs
+import base64
+import heapq
+import zipfile
+import random
+import multiprocessing
+import sys
+import contextlib
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from collections import namedtuple
+from functools import lru_cache
+from itertools import groupby
 
 from difflib import SequenceMatcher
 from difflib import Differ
+from difflib import Match
+from bisect import bisect_left
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class DiffTimeout(Exception):
+    pass
+
+def check_deadline(deadline):
+    # the diff timeout is cooperative, the matchers and UnifiedDiffer check it between steps
+    if deadline is not None and time.monotonic() > deadline:
+        raise DiffTimeout
+
+def intern_lines(a, b):
+    """Map every distinct line of a and b to a small int, so the diff algorithms only compare ints."""
+    ids = {}
+    return [ids.setdefault(line, len(ids)) for line in a], [ids.setdefault(line, len(ids)) for line in b]
+
+def myers_middle_snake(a, alo, ahi, b, blo, bhi, deadline=None):
+    """
+    Find the middle snake of the shortest edit script between a[alo:ahi] and b[blo:bhi]
+    (Myers, "An O(ND) Difference Algorithm and Its Variations", section 4b).
+    Returns (x_start, y_start, x_end, y_end) in absolute indexes.
+    """
+    n, m = ahi - alo, bhi - blo
+    delta = n - m
+    odd = delta % 2 == 1
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    vf = [0] * (2 * max_d + 3)
+    vb = [0] * (2 * max_d + 3)
+    for d in range(max_d + 1):
+        check_deadline(deadline)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[offset + k - 1] < vf[offset + k + 1]):
+                x = vf[offset + k + 1]
+            else:
+                x = vf[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[offset + k] = x
+            c = delta - k
+            if odd and -(d - 1) <= c <= d - 1 and x + vb[offset + c] >= n:
+                return alo + x0, blo + y0, alo + x, blo + y
+        for c in range(-d, d + 1, 2):
+            if c == -d or (c != d and vb[offset + c - 1] < vb[offset + c + 1]):
+                x = vb[offset + c + 1]
+            else:
+                x = vb[offset + c - 1] + 1
+            y = x - c
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            vb[offset + c] = x
+            k = delta - c
+            if not odd and -d <= k <= d and x + vf[offset + k] >= n:
+                return ahi - x, bhi - y, ahi - x0, bhi - y0
+    raise AssertionError('no middle snake found')
+
+def myers_matches(a, alo, ahi, b, blo, bhi, matches, deadline=None):
+    """Append the (i, j) pairs of matching lines of a Myers shortest edit script to `matches`, in linear space."""
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        check_deadline(deadline)
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        x, y, u, v = myers_middle_snake(a, alo, ahi, b, blo, bhi, deadline)
+        matches.extend((x + k, y + k) for k in range(u - x))
+        stack.append((alo, x, blo, y))
+        stack.append((u, ahi, v, bhi))
+
+def patience_matches(a, alo, ahi, b, blo, bhi, matches, deadline=None):
+    """
+    Patience diff: anchor on the lines that are unique in both ranges, keep the longest
+    increasing run of them and diff the gaps in between, falling back to Myers for gaps
+    without unique lines.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        check_deadline(deadline)
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        a_count, b_index = {}, {}
+        for i in range(alo, ahi):
+            a_count[a[i]] = a_count.get(a[i], 0) + 1
+        for j in range(blo, bhi):
+            b_index[b[j]] = -1 if b[j] in b_index else j
+        a_unique = [(i, b_index[a[i]]) for i in range(alo, ahi) if a_count[a[i]] == 1 and b_index.get(a[i], -1) >= 0]
+        if not a_unique:
+            myers_matches(a, alo, ahi, b, blo, bhi, matches, deadline=deadline)
+            continue
+
+        # longest increasing subsequence of b positions, by patience sorting
+        pile_tops, pile_top_js, back = [], [], []
+        for n, (i, j) in enumerate(a_unique):
+            pile = bisect_left(pile_top_js, j)
+            back.append(pile_tops[pile - 1] if pile > 0 else -1)
+            if pile == len(pile_tops):
+                pile_tops.append(n)
+                pile_top_js.append(j)
+            else:
+                pile_tops[pile] = n
+                pile_top_js[pile] = j
+        anchors = []
+        n = pile_tops[-1]
+        while n >= 0:
+            anchors.append(a_unique[n])
+            n = back[n]
+        anchors.reverse()
+
+        prev_i, prev_j = alo, blo
+        for i, j in anchors:
+            matches.append((i, j))
+            stack.append((prev_i, i, prev_j, j))
+            prev_i, prev_j = i + 1, j + 1
+        stack.append((prev_i, ahi, prev_j, bhi))
+
+def histogram_matches(a, alo, ahi, b, blo, bhi, matches, max_occurrences=64, deadline=None):
+    """
+    Histogram diff (as in JGit/git): split on the longest common region around the line
+    that occurs least often in a, then diff both sides of it, falling back to Myers when
+    every common line is too frequent.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        check_deadline(deadline)
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        positions = {}
+        for i in range(alo, ahi):
+            positions.setdefault(a[i], []).append(i)
+
+        best = None
+        j = blo
+        while j < bhi:
+            occurrences = positions.get(b[j])
+            if occurrences is None or len(occurrences) > max_occurrences:
+                j += 1
+                continue
+            next_j = j + 1
+            for i in occurrences:
+                si, sj = i, j
+                while si > alo and sj > blo and a[si - 1] == b[sj - 1]:
+                    si -= 1
+                    sj -= 1
+                ei, ej = i + 1, j + 1
+                while ei < ahi and ej < bhi and a[ei] == b[ej]:
+                    ei += 1
+                    ej += 1
+                key = (len(occurrences), si - ei)
+                if best is None or key < best[0]:
+                    best = (key, si, sj, ei - si)
+                next_j = max(next_j, ej)
+            j = next_j
+
+        if best is None:
+            myers_matches(a, alo, ahi, b, blo, bhi, matches, deadline=deadline)
+            continue
+        _, si, sj, size = best
+        matches.extend((si + k, sj + k) for k in range(size))
+        stack.append((alo, si, blo, sj))
+        stack.append((si + size, ahi, sj + size, bhi))
+
+class LineMatcher(SequenceMatcher):
+    """
+    SequenceMatcher replacement for diffing lists of lines with a different algorithm.
+
+    Only get_matching_blocks() is reimplemented (on interned lines), so get_opcodes()
+    and get_grouped_opcodes() produce exactly the format UnifiedDiffer expects.
+    """
+    algorithm = staticmethod(myers_matches)
+    deadline = None
+
+    def __init__(self, isjunk=None, a='', b='', autojunk=True):
+        super().__init__(None, a, b, autojunk)
+
+    def set_seq2(self, b):
+        # the b2j index built by SequenceMatcher is never used here, skip building it
+        self.b = b
+        self.matching_blocks = self.opcodes = None
+        self.fullbcount = None
+
+    def get_matching_blocks(self):
+        if self.matching_blocks is not None:
+            return self.matching_blocks
+
+        a, b = intern_lines(self.a, self.b)
+        matches = []
+        self.algorithm(a, 0, len(a), b, 0, len(b), matches, deadline=self.deadline)
+        matches.sort()
+
+        blocks = []
+        for i, j in matches:
+            if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+                blocks[-1][2] += 1
+            else:
+                blocks.append([i, j, 1])
+        self.matching_blocks = [Match(i, j, size) for i, j, size in blocks] + [Match(len(a), len(b), 0)]
+        return self.matching_blocks
+
+class MyersMatcher(LineMatcher):
+    algorithm = staticmethod(myers_matches)
+
+class PatienceMatcher(LineMatcher):
+    algorithm = staticmethod(patience_matches)
+
+class HistogramMatcher(LineMatcher):
+    algorithm = staticmethod(histogram_matches)
+
+class DifflibMatcher(SequenceMatcher):
+    """difflib's SequenceMatcher, checking the diff deadline before each longest match search."""
+    deadline = None
+
+    def find_longest_match(self, alo=0, ahi=None, blo=0, bhi=None):
+        check_deadline(self.deadline)
+        return super().find_longest_match(alo, ahi, blo, bhi)
+
+DIFF_MATCHERS = {
+    'difflib': DifflibMatcher,
+    'myers': MyersMatcher,
+    'patience': PatienceMatcher,
+    'histogram': HistogramMatcher,
+}
 
 class UnifiedDiffer(Differ):
+    def __init__(self, linejunk=None, charjunk=None, matcher=SequenceMatcher, intraline_max_lines=200, intraline_max_line_length=20000, deadline=None):
+        super().__init__(linejunk, charjunk)
+        self.matcher = matcher
+        self.intraline_max_lines = intraline_max_lines
+        self.intraline_max_line_length = intraline_max_line_length
+        # time.monotonic() after which DiffTimeout is raised, see check_deadline
+        self.deadline = deadline
+
     def unified_diff(self, a, b, fromfile='', tofile='', fromfiledate='',
                  tofiledate='', n=3, lineterm='\n'):
         r"""
@@ -44,7 +340,9 @@ class UnifiedDiffer(Differ):
         """
 
         started = False
-        for group in SequenceMatcher(None,a,b).get_grouped_opcodes(n):
+        matcher = self.matcher(None, a, b)
+        matcher.deadline = self.deadline
+        for group in matcher.get_grouped_opcodes(n):
             if not started:
                 fromdate = '\t%s' % fromfiledate if fromfiledate else ''
                 todate = '\t%s' % tofiledate if tofiledate else ''
@@ -55,51 +353,444 @@ class UnifiedDiffer(Differ):
             yield "@@ -%d,%d +%d,%d @@%s" % (i1+1, i2-i1, j1+1, j2-j1, lineterm)
             for tag, i1, i2, j1, j2 in group:
                 if tag == 'replace':
-                    for line in a[i1:i2]:
-                        g = self._fancy_replace(a, i1, i2, b, j1, j2)
+                    g = self._fancy_replace(a, i1, i2, b, j1, j2)
                 elif tag == 'equal':
-                    for line in a[i1:i2]:
-                        g = self._dump(' ', a, i1, i2)
-                    if n > 0:
-                        for line in g:
-                            yield line
-                    continue
+                    if n <= 0:
+                        continue
+                    g = self._dump(' ', a, i1, i2)
                 elif tag == 'delete':
-                    for line in a[i1:i2]:
-                        g = self._dump('-', a, i1, i2)
+                    g = self._dump('-', a, i1, i2)
                 elif tag == 'insert':
-                    for line in b[j1:j2]:
-                        g = self._dump('+', b, j1, j2)
+                    g = self._dump('+', b, j1, j2)
                 else:
                     raise ValueError
 
+                if self.deadline is None:
+                    yield from g
+                    continue
                 for line in g:
+                    check_deadline(self.deadline)
                     yield line
 
+    def _fancy_replace(self, a, alo, ahi, b, blo, bhi):
+        # intraline matching compares every line of one block with every line of the
+        # other, so large replaced blocks or very long lines fall back to plain -/+ lines
+        if max(ahi - alo, bhi - blo) > self.intraline_max_lines or \
+              any(len(line) > self.intraline_max_line_length for line in a[alo:ahi]) or \
+              any(len(line) > self.intraline_max_line_length for line in b[blo:bhi]):
+            yield from self._plain_replace(a, alo, ahi, b, blo, bhi)
+        elif self.deadline is None:
+            yield from super()._fancy_replace(a, alo, ahi, b, blo, bhi)
+        else:
+            yield from self._fancy_replace_until_deadline(a, alo, ahi, b, blo, bhi)
+
+    def _fancy_replace_until_deadline(self, a, alo, ahi, b, blo, bhi):
+        # Differ._fancy_replace, except that the similar line search, which runs before the
+        # first line is yielded, and the character matching check the diff deadline
+        best_ratio, cutoff = 0.74, 0.75
+        cruncher = DifflibMatcher(self.charjunk)
+        cruncher.deadline = self.deadline
+        eqi, eqj = None, None
+        for j in range(blo, bhi):
+            bj = b[j]
+            cruncher.set_seq2(bj)
+            for i in range(alo, ahi):
+                check_deadline(self.deadline)
+                ai = a[i]
+                if ai == bj:
+                    if eqi is None:
+                        eqi, eqj = i, j
+                    continue
+                cruncher.set_seq1(ai)
+                if cruncher.real_quick_ratio() > best_ratio and \
+                      cruncher.quick_ratio() > best_ratio and \
+                      cruncher.ratio() > best_ratio:
+                    best_ratio, best_i, best_j = cruncher.ratio(), i, j
+        if best_ratio < cutoff:
+            if eqi is None:
+                yield from self._plain_replace(a, alo, ahi, b, blo, bhi)
+                return
+            best_i, best_j, best_ratio = eqi, eqj, 1.0
+        else:
+            eqi = None
 
-def get_ruler_span(ruler = '&nbsp;', color = '#8080808a'):
-    return f"""
-        <div style='color: {color}; display: inline-flex; width: 20px; margin-right: 5px; justify-content: center'>
-            &nbsp;{ruler}&nbsp;
-        </div>
+        yield from self._fancy_helper(a, alo, best_i, b, blo, best_j)
+
+        aelt, belt = a[best_i], b[best_j]
+        if eqi is None:
+            atags = btags = ""
+            cruncher.set_seqs(aelt, belt)
+            for tag, ai1, ai2, bj1, bj2 in cruncher.get_opcodes():
+                la, lb = ai2 - ai1, bj2 - bj1
+                if tag == 'replace':
+                    atags += '^' * la
+                    btags += '^' * lb
+                elif tag == 'delete':
+                    atags += '-' * la
+                elif tag == 'insert':
+                    btags += '+' * lb
+                elif tag == 'equal':
+                    atags += ' ' * la
+                    btags += ' ' * lb
+                else:
+                    raise ValueError('unknown tag %r' % (tag,))
+            yield from self._qformat(aelt, belt, atags, btags)
+        else:
+            yield '  ' + aelt
+
+        yield from self._fancy_helper(a, best_i+1, ahi, b, best_j+1, bhi)
+
+
+class BufferedStore:
+    """
+    Write buffering of the SQLite stores, which several processes can share (--parallel-jobs
+    rows using one --cache-dir or --state-file). Puts and the bookkeeping of reads are kept in
+    memory and written in one short transaction every FLUSH_INTERVAL seconds or MAX_PENDING
+    writes, so no connection holds the database's write lock while it compares files.
+    Subclasses set self.conn and self.lock and implement _write(rows, used).
+    """
+    FLUSH_INTERVAL = 1.0
+    MAX_PENDING = 1000
+
+    def __init__(self):
+        self.pending = {}
+        self.used = {}
+        self.last_flush = time.monotonic()
+
+    def _written(self):
+        if len(self.pending) + len(self.used) >= self.MAX_PENDING or time.monotonic() - self.last_flush >= self.FLUSH_INTERVAL:
+            self._flush()
+
+    def _flush(self):
+        if self.pending or self.used:
+            with self.conn:
+                self._write(list(self.pending.values()), list(self.used.items()))
+        self.pending.clear()
+        self.used.clear()
+        self.last_flush = time.monotonic()
+
+class DigestCache(BufferedStore):
+    """
+    SQLite backed cache of file digests, stored in `digests.sqlite` under `cache_dir`.
+
+    Entries are keyed by absolute path and only reused while the (size, mtime, inode)
+    signature of the file still matches, otherwise the file is re-hashed. The least
+    recently used entries beyond `max_entries` are evicted on close.
+    """
+    # files modified this recently may still change within the same mtime tick
+    MTIME_GRACE_NS = 2 * 10**9
+
+    def __init__(self, cache_dir, max_entries=1000000):
+        super().__init__()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'digests.sqlite'), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT, sha256 TEXT, last_used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)')
+        self.conn.commit()
+
+    def get(self, file_path, file_stat):
+        key = os.path.abspath(file_path)
+        with self.lock:
+            row = self.pending.get(key) or self.conn.execute('SELECT path, size, mtime_ns, inode, md5, sha256 FROM digests WHERE path = ?', (key,)).fetchone()
+            if row is None or tuple(row[1:4]) != (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+                return None
+            self.used[key] = time.time()
+            self._written()
+            return row[4], row[5]
+
+    def put(self, file_path, file_stat, digests):
+        if time.time_ns() - file_stat.st_mtime_ns < self.MTIME_GRACE_NS:
+            return
+        key = os.path.abspath(file_path)
+        with self.lock:
+            self.pending[key] = (key, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, *digests, time.time())
+            self._written()
+
+    def _write(self, rows, used):
+        self.conn.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.executemany('UPDATE digests SET last_used = ? WHERE path = ?', [(last_used, key) for key, last_used in used])
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.execute('DELETE FROM digests WHERE path IN (SELECT path FROM digests ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self.conn.commit()
+            self.conn.close()
+
+def content_digests(data):
+    return hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()
+
+def file_digests(file_path, file_stat=None, cache=None, chunk_size=1024 * 1024):
+    """Return the (md5, sha256) hex digests of a file, read in chunks and reusing `cache` when possible."""
+    if file_stat is None:
+        file_stat = os.stat(file_path)
+    if cache is not None:
+        digests = cache.get(file_path, file_stat)
+        if digests is not None:
+            return digests
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with profile_phase('hash'), open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    digests = (md5.hexdigest(), sha256.hexdigest())
+    if active_profiler is not None:
+        active_profiler.count_read(file_stat.st_size)
+
+    if cache is not None:
+        cache.put(file_path, file_stat, digests)
+    return digests
+
+class ManifestDigestCache:
+    """
+    Digest lookup that answers from prebuilt directory manifests first, see build_manifest,
+    and falls back to `cache` (a DigestCache or None) for files outside of them or whose
+    size/mtime no longer match the manifest.
     """
-def get_file_properties_table(file_path, show_md5_hash = False):
+    def __init__(self, manifests, cache=None):
+        self.manifests = {os.path.normpath(directory): manifest for directory, manifest in manifests.items()}
+        self.cache = cache
+
+    def get(self, file_path, file_stat):
+        for directory, manifest in self.manifests.items():
+            if file_path.startswith(directory + os.sep):
+                # compare_dirs joins the walked paths onto the normalized directory, no relpath needed
+                entry = manifest.get(file_path[len(directory) + 1:])
+                if entry is not None and entry[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+                    return entry[2:]
+        return self.cache.get(file_path, file_stat) if self.cache is not None else None
+
+    def put(self, file_path, file_stat, digests):
+        if self.cache is not None:
+            self.cache.put(file_path, file_stat, digests)
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+def build_manifest(directory, cache=None, jobs=1, path_filter=None):
+    """Walk `directory` once and return {relpath: (size, mtime_ns, md5, sha256)} for all of its files."""
+    directory = os.path.normpath(directory)
+    files = [(relpath, file_stat) for relpath, entry, _ in walk_dirs(directory, None, path_filter=path_filter) if (file_stat := stat_entry(entry)) is not None]
+
+    def manifest_entry(file):
+        relpath, file_stat = file
+        return relpath, (file_stat.st_size, file_stat.st_mtime_ns, *file_digests(os.path.join(directory, relpath), file_stat, cache))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return dict(pool.map(manifest_entry, files))
+
+MANIFEST_MAGIC = '#compare-directory-manifest'
+MANIFEST_VERSION = 1
+
+# stat of a file recorded in a manifest, `content` is its compressed text (or None when not stored)
+ManifestStat = namedtuple('ManifestStat', 'st_size st_mtime st_mtime_ns st_ino content codec')
+ManifestDir = namedtuple('ManifestDir', 'manifest relpath')
+ManifestDirEntry = namedtuple('ManifestDirEntry', 'name path')
+
+class ManifestEntry:
+    """os.DirEntry look-alike for a file recorded in a manifest, so walk_dirs can walk snapshots."""
+    def __init__(self, name, file_stat):
+        self.name = name
+        self.file_stat = file_stat
+
+    def stat(self):
+        return self.file_stat
+
+    def is_dir(self):
+        return False
+
+    def is_symlink(self):
+        return False
+
+class Manifest:
+    """
+    A directory snapshot loaded with load_manifest: `digests` has the build_manifest
+    format {relpath: (size, mtime_ns, md5, sha256)} and `tree` maps every directory
+    relpath to the ({name: ManifestEntry}, {name: ManifestDirEntry}) listing of it.
+    """
+    def __init__(self, header):
+        self.header = header
+        self.digests = {}
+        self.tree = {'': ({}, {})}
+
+    def add(self, record):
+        relpath = os.path.normpath(record['path'])
+        content = base64.b64decode(record['content']) if 'content' in record else None
+        file_stat = ManifestStat(record['size'], record['mtime_ns'] / 1e9, record['mtime_ns'], 0, content, self.header['codec'])
+        self.digests[relpath] = (record['size'], record['mtime_ns'], record['md5'], record['sha256'])
+
+        parent, name = os.path.split(relpath)
+        self.listing(parent)[0][name] = ManifestEntry(name, file_stat)
+
+    def listing(self, relpath):
+        if relpath not in self.tree:
+            self.tree[relpath] = ({}, {})
+            parent, name = os.path.split(relpath)
+            self.listing(parent)[1][name] = ManifestDirEntry(name, ManifestDir(self, relpath))
+        return self.tree[relpath]
+
+def compress_content(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data, 6)
+
+def decompress_content(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('This manifest stores zstd compressed content, install the zstandard package to read it.')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def is_manifest_file(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC.encode()
+
+@lru_cache(maxsize=4)
+def load_manifest(manifest_file):
+    with open(manifest_file, encoding='utf8') as f:
+        magic, version = f.readline().split()
+        if magic != MANIFEST_MAGIC or int(version[1:]) > MANIFEST_VERSION:
+            raise ValueError(f'{manifest_file} is not a supported manifest (found {magic} {version}).')
+        manifest = Manifest(json.loads(f.readline()))
+        for line in f:
+            manifest.add(json.loads(line))
+    return manifest
+
+def write_manifest(directory, manifest_file, ignore_file_extensions=[], max_content_size=1024 * 1024, cache=None, jobs=1, path_filter=None):
+    """
+    Write a snapshot of `directory` that can later be compared in place of it: one header
+    line, then one JSON record per file with its size, mtime and digests, plus the
+    compressed content of text files up to `max_content_size` bytes so they can be diffed.
+    """
+    directory = os.path.normpath(directory)
+    codec = 'zstd' if zstandard is not None else 'zlib'
+    digests = build_manifest(directory, cache, jobs, path_filter)
+    with open(manifest_file, 'w', encoding='utf8') as f:
+        f.write(f'{MANIFEST_MAGIC} v{MANIFEST_VERSION}\n')
+        f.write(json.dumps({'version': MANIFEST_VERSION, 'root': os.path.abspath(directory), 'created': time.time(), 'codec': codec}) + '\n')
+        for relpath in sorted(digests):
+            size, mtime_ns, md5, sha256 = digests[relpath]
+            record = {'path': relpath.replace(os.sep, '/'), 'size': size, 'mtime_ns': mtime_ns, 'md5': md5, 'sha256': sha256}
+            if size <= max_content_size and os.path.splitext(relpath)[1][1:] not in ignore_file_extensions:
+                with open(os.path.join(directory, relpath), 'rb') as content_file:
+                    data = content_file.read()
+                if sniff_encoding(data[:BINARY_SNIFF_SIZE]) is not None:
+                    record['content'] = base64.b64encode(compress_content(codec, data)).decode('ascii')
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+    return len(digests)
+
+# text that is not valid utf8 is decoded with this instead, it accepts any byte sequence
+FALLBACK_ENCODING = 'latin-1'
+BINARY_SNIFF_SIZE = 8192
+# control bytes other than \b \t \n \f \r and escape, common in binaries but rare in text of any encoding
+BINARY_CONTROL_BYTES = bytes(sorted(set(range(32)) - {8, 9, 10, 12, 13, 27})) + b'\x7f'
+
+def sniff_encoding(block):
+    """Return the encoding to decode content starting with `block` with, or None if it looks binary."""
+    if b'\0' in block:
+        return None
+    try:
+        # not final, so a multi-byte character cut at the end of the block is not an error
+        codecs.getincrementaldecoder('utf8')().decode(block)
+        return 'utf8'
+    except UnicodeDecodeError:
+        pass
+    if len(block.translate(None, BINARY_CONTROL_BYTES)) < len(block) * 0.9:
+        return None
+    return FALLBACK_ENCODING
+
+class FileContent:
+    """
+    Read-only view of a file's bytes, memory mapped for files on disk, that sniffs whether
+    the content is text from its first block and only decodes it when the lines are needed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.encoding = sniff_encoding(data[:BINARY_SNIFF_SIZE])
+
+    @classmethod
+    def open(cls, file_path, file_stat=None):
+        if isinstance(file_stat, ManifestStat):
+            return cls(decompress_content(file_stat.codec, file_stat.content) if file_stat.content is not None else b'')
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def is_binary(self):
+        return self.encoding is None
+
+    def lines(self):
+        try:
+            text = str(self.data, self.encoding)
+        except UnicodeDecodeError:
+            # only the first block was valid utf8
+            text = str(self.data, FALLBACK_ENCODING)
+        # universal newlines, the same lines readlines() on a text mode file would give
+        return io.StringIO(text, newline=None).readlines()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def is_binary_file(file_path, file_stat):
+    if isinstance(file_stat, ManifestStat):
+        # manifests only keep the content of text files, a file without content is binary or unknown
+        return file_stat.content is None
+    if active_profiler is not None:
+        active_profiler.count_read(min(file_stat.st_size, BINARY_SNIFF_SIZE))
+    with FileContent.open(file_path, file_stat) as content:
+        return content.is_binary()
+
+def read_lines(file_path, file_stat):
+    with FileContent.open(file_path, file_stat) as content:
+        return content.lines()
+
+# diff lines are styled by short classes defined once in the report's <style> block
+RULER_CLASSES = {'+': 'ra', '-': 'rd'}
+
+def get_ruler_span(ruler = '&nbsp;'):
+    return f"<span class='{RULER_CLASSES.get(ruler, 'r')}'>{ruler}</span>"
+def get_file_properties_table(file_path, md5_hash = None, file_stat = None, line_count = None):
+    if file_stat is None:
+        file_stat = os.stat(file_path)
     md5_hash_tr = f"""
         <tr>
             <td>MD5 Hash</td>
-            <td>{hashlib.md5(open(file_path,'rb').read()).hexdigest()}</td>
+            <td>{md5_hash}</td>
         </tr>
-    """ if show_md5_hash else ""
+    """ if md5_hash else ""
+    if line_count is not None:
+        md5_hash_tr += f"""
+        <tr>
+            <td>Lines</td>
+            <td>{line_count}</td>
+        </tr>
+    """
 
     return f"""
         <table class='no-border'>
             <tr>
                 <td>File size</td>
-                <td>{sizeof_fmt(os.path.getsize(file_path))}</td>
+                <td>{sizeof_fmt(file_stat.st_size)}</td>
             </tr>
             <tr>
                 <td>Last modified time</td>
-                <td>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(file_path)))}</td>
+                <td>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(file_stat.st_mtime))}</td>
             </tr>
             {md5_hash_tr}
         </table>
@@ -112,22 +803,22 @@ def sizeof_fmt(num, suffix="B"):
         num /= 1024.000
     return f"{num:.1f}Yi{suffix}"
 
+MERGE_STR_DIFF_SPANS = {
+    '+': "<span class='ia'>",
+    '-': "<span class='id'>",
+    '^': "<span class='ic'>",
+}
+MERGE_STR_DIFF_RUNS = re.compile(r'\++|-+|\^+|[^-+^]+')
+
 def merge_str_diff(str, cdiff):
-    result = ''
-    for i in range(len(str)):
-        if i >= len(cdiff):
-            result += html.escape(str[i])
-        elif cdiff[i] == ' ':
-            result += html.escape(str[i])
-        elif cdiff[i] == '+':
-            result += '<span style="color: white; background-color: green">' + html.escape(str[i]) + '</span>'
-        elif cdiff[i] == '-':
-            result += '<span style="color: white; background-color: red">' + html.escape(str[i]) + '</span>'
-        elif cdiff[i] == '^':
-            result += '<span style="background-color: yellow">' + html.escape(str[i]) + '</span>'
-        else:
-            result += html.escape(str[i])
-    return result
+    # one escaped span per run of identical markers, instead of one span per character
+    result = []
+    for run in MERGE_STR_DIFF_RUNS.finditer(cdiff, 0, len(str)):
+        segment = html.escape(str[run.start():run.end()])
+        span = MERGE_STR_DIFF_SPANS.get(run.group()[0])
+        result.append(f'{span}{segment}</span>' if span else segment)
+    result.append(html.escape(str[len(cdiff):]))
+    return ''.join(result)
 
 def parse_tag_file_list(tag_file_list):
     tag_dict = {}
@@ -137,42 +828,1179 @@ def parse_tag_file_list(tag_file_list):
     return tag_dict
 
 def transform_file_tags_dict(tag_files_dict):
+    """
+    Build the tag lookup index used by generate_file_path_td, once per report.
+
+    Returns (file_tags_dict, tag_patterns): file_tags_dict maps each normalized relative
+    path to its set of tags, tag_patterns maps a tag to one compiled regex combining all
+    of its glob (`*`, `?`, `[...]`) and directory prefix (`path/to/dir/`) entries.
+    """
     file_tags_dict = {}
+    tag_globs = {}
     for tag, files in tag_files_dict.items():
         for file in files:
-            if file in file_tags_dict:
-                file_tags_dict[file].append(tag)
+            if file.endswith(('/', '\\')):
+                file += '*'
+            if any(c in file for c in '*?['):
+                tag_globs.setdefault(tag, []).append(fnmatch.translate(os.path.normpath(file)))
             else:
-                file_tags_dict[file] = [tag]
-    return file_tags_dict
-
-def generate_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_dict):
+                file_tags_dict.setdefault(os.path.normpath(file), set()).add(tag)
+    tag_patterns = {tag: re.compile('|'.join(globs)) for tag, globs in tag_globs.items()}
+    return file_tags_dict, tag_patterns
+
+def lookup_file_tags(normalized_file_path, file_tags_index):
+    file_tags_dict, tag_patterns = file_tags_index
+    file_tags = set(file_tags_dict.get(normalized_file_path, ()))
+    for tag, pattern in tag_patterns.items():
+        if tag not in file_tags and pattern.match(normalized_file_path):
+            file_tags.add(tag)
+    return sorted(file_tags)
+
+def generate_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_index):
     relative_file_path = os.path.relpath(file_path1, dir1)
     file_path_td = f"<td class='ten'><span class='content' data-fp1='{file_path1}' data-fp2='{file_path2}'>{relative_file_path}</span></td>"
-    tags = []
-    for file_path_key, tag_list in file_tags_dict.items():
-        # check if file_path_key is equal to file_path (os independent)
-        if os.path.normpath(file_path_key) == os.path.normpath(relative_file_path):
-            tags.extend(tag_list)
-    file_tags = set()
-    for tag in tags:
-        file_tags.add(tag)
+
+    normalized_file_path = os.path.normpath(relative_file_path)
+    file_tags = lookup_file_tags(normalized_file_path, file_tags_index)
 
     if len(file_tags) > 0:
         file_tags_span_list = [f"<span class='tags'>{tag}</span>" for tag in file_tags]
-        file_path_td = f"<td class='ten'><span class='content' data-fp1='{file_path1}' data-fp2='{file_path2}'>{os.path.normpath(relative_file_path)}</span>{''.join(file_tags_span_list)}</td>"
+        file_path_td = f"<td class='ten'><span class='content' data-fp1='{file_path1}' data-fp2='{file_path2}'>{normalized_file_path}</span>{''.join(file_tags_span_list)}</td>"
     
     return file_path_td
 
-def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, tags_csv=''):
+def scandir_split(path):
+    files, dirs = {}, {}
+    if path is None:
+        return files, dirs
+    if isinstance(path, ManifestDir):
+        files, dirs = path.manifest.tree.get(path.relpath, ({}, {}))
+        return files, dirs
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # like os.walk, symlinked directories are listed but not followed
+                    if not entry.is_symlink():
+                        dirs[entry.name] = entry
+                else:
+                    files[entry.name] = entry
+    except OSError:
+        # unreadable directories are skipped, the same as os.walk
+        pass
+    return files, dirs
+
+def stat_entry(entry):
+    """entry.stat(), or None for a dangling symlink or a file deleted since it was listed, which then counts as missing on that side."""
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+class PathFilter:
+    """
+    --include/--exclude glob patterns, compiled once and applied while walking.
+
+    A pattern without a slash matches a file or directory name at any depth, one with a
+    slash matches the path relative to the roots, and a trailing slash only matches
+    directories. Excluded directories are pruned, so nothing below them is listed or
+    stat'ed. With include patterns only matching files, or files below a matching
+    directory, are compared. Excluded files and directories are counted.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+        self.excluded_files = 0
+        self.excluded_dirs = 0
+
+    @staticmethod
+    def compile(patterns):
+        globs = {}
+        for pattern in patterns:
+            pattern = pattern.strip().replace('\\', '/')
+            dirs_only = pattern.endswith('/')
+            by_name = '/' not in pattern.rstrip('/')
+            pattern = pattern.strip('/')
+            if pattern:
+                globs.setdefault((by_name, dirs_only), []).append(fnmatch.translate(pattern))
+        return {key: re.compile('|'.join(group)) for key, group in globs.items()}
+
+    @staticmethod
+    def matches(regexes, name, relpath, is_dir):
+        relpath = relpath.replace(os.sep, '/')
+        return any((is_dir or not dirs_only) and regex.match(name if by_name else relpath) for (by_name, dirs_only), regex in regexes.items())
+
+    def accepts_dir(self, name, relpath):
+        if self.matches(self.exclude, name, relpath, True):
+            self.excluded_dirs += 1
+            return False
+        return True
+
+    def includes_dir(self, name, relpath):
+        return not self.include or self.matches(self.include, name, relpath, True)
+
+    def accepts_file(self, name, relpath, included=False):
+        if self.matches(self.exclude, name, relpath, False) or not (included or not self.include or self.matches(self.include, name, relpath, False)):
+            self.excluded_files += 1
+            return False
+        return True
+
+def read_ignore_file(ignore_file):
+    """Exclude patterns of a .compareignore file, one glob per line, blank lines and # comments skipped."""
+    with open(ignore_file, encoding='utf8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+def walk_dirs(dir1, dir2, relpath='', path_filter=None, included=False):
+    """
+    Walk both directory trees in sorted lockstep and yield (relpath, entry1, entry2)
+    for every file, where entry1/entry2 is the os.DirEntry on that side or None
+    if the file only exists on the other side. Either side may be a manifest file
+    written by write_manifest, which is then walked instead of a directory.
+    Paths rejected by `path_filter` (a PathFilter) are skipped, directories without descending.
+    """
+    if relpath == '':
+        dir1 = ManifestDir(load_manifest(dir1), '') if dir1 is not None and is_manifest_file(dir1) else dir1
+        dir2 = ManifestDir(load_manifest(dir2), '') if dir2 is not None and is_manifest_file(dir2) else dir2
+    files1, dirs1 = scandir_split(dir1)
+    files2, dirs2 = scandir_split(dir2)
+
+    for name in sorted(files1.keys() | files2.keys()):
+        file_relpath = os.path.join(relpath, name)
+        if path_filter is None or path_filter.accepts_file(name, file_relpath, included):
+            yield file_relpath, files1.get(name), files2.get(name)
+
+    for name in sorted(dirs1.keys() | dirs2.keys()):
+        dir_relpath = os.path.join(relpath, name)
+        if path_filter is not None and not path_filter.accepts_dir(name, dir_relpath):
+            continue
+        subdir1 = dirs1[name].path if name in dirs1 else None
+        subdir2 = dirs2[name].path if name in dirs2 else None
+        sub_included = included or (path_filter is not None and bool(path_filter.include) and path_filter.includes_dir(name, dir_relpath))
+        yield from walk_dirs(subdir1, subdir2, dir_relpath, path_filter, sub_included)
+
+def read_head_tail(file_path, file_size, sample_size=64 * 1024):
+    with profile_phase('hash'), open(file_path, 'rb') as f:
+        head = f.read(sample_size)
+        if file_size > 2 * sample_size:
+            f.seek(-sample_size, os.SEEK_END)
+        data = head + f.read()
+    if active_profiler is not None:
+        active_profiler.count_read(len(data))
+    return data
+
+def files_identical(file_path1, file_path2, stat1, stat2, cache=None, sample_size=64 * 1024):
+    """
+    Decide whether two files have the same content, doing as little I/O as possible:
+    differing sizes, then cached digests, then the first and last `sample_size` bytes, and
+    only then a full streamed hash of the sides that are not cached yet. With a cache,
+    files small enough to be read whole by the sample are hashed from it and cached as well.
+
+    Returns (identical, digests1, digests2), the digests are None unless they were
+    already cached or had to be computed.
+    """
+    if stat1.st_size != stat2.st_size:
+        return False, None, None
+
+    digests1 = cache.get(file_path1, stat1) if cache is not None else None
+    digests2 = cache.get(file_path2, stat2) if cache is not None else None
+    if digests1 and digests2:
+        return digests1[1] == digests2[1], digests1, digests2
+    if isinstance(stat1, ManifestStat) or isinstance(stat2, ManifestStat):
+        # a snapshot has no bytes to sample, it is cached so only the other side is hashed
+        digests1 = digests1 or file_digests(file_path1, stat1, cache)
+        digests2 = digests2 or file_digests(file_path2, stat2, cache)
+        return digests1[1] == digests2[1], digests1, digests2
+
+    # even when one side is cached (e.g. a shared baseline), differing samples are cheaper
+    # to find than a full hash of the other side
+    sample1 = read_head_tail(file_path1, stat1.st_size, sample_size)
+    sample2 = read_head_tail(file_path2, stat2.st_size, sample_size)
+    if cache is not None and stat1.st_size <= 2 * sample_size:
+        # the samples are the whole files, hash them so the next run finds both in the cache
+        if digests1 is None:
+            digests1 = content_digests(sample1)
+            cache.put(file_path1, stat1, digests1)
+        if digests2 is None:
+            digests2 = content_digests(sample2)
+            cache.put(file_path2, stat2, digests2)
+    if sample1 != sample2:
+        return False, digests1, digests2
+    if stat1.st_size <= 2 * sample_size:
+        # the samples already covered both files entirely
+        return True, digests1, digests2
+
+    digests1 = digests1 or file_digests(file_path1, stat1, cache)
+    digests2 = digests2 or file_digests(file_path2, stat2, cache)
+    return digests1[1] == digests2[1], digests1, digests2
+
+def classify_file_pair(file_path1, file_path2, stat1, stat2, ignore_file_extensions=[], cache=None):
+    """Return (status, md5_hash1, md5_hash2), the hashes are only set for 'ignored' (hash compared) files."""
+    if stat1 is None:
+        return 'added', None, None
+    if stat2 is None:
+        return 'removed', None, None
+
+    identical, digests1, digests2 = files_identical(file_path1, file_path2, stat1, stat2, cache)
+
+    if identical:
+        return 'identical', None, None
+    if os.path.splitext(file_path1)[1][1:] in ignore_file_extensions:
+        if is_archive(file_path1) and not isinstance(stat1, ManifestStat) and not isinstance(stat2, ManifestStat):
+            # archives are compared member by member from their central directories when rendered
+            return 'ignored', digests1 and digests1[0], digests2 and digests2[0]
+        digests1 = digests1 or file_digests(file_path1, stat1, cache)
+        digests2 = digests2 or file_digests(file_path2, stat2, cache)
+        return 'ignored', digests1[0], digests2[0]
+    if any(isinstance(file_stat, ManifestStat) and file_stat.content is None for file_stat in (stat1, stat2)):
+        # the snapshot did not keep this file's content, so only the hashes can be shown
+        digests1 = digests1 or file_digests(file_path1, stat1, cache)
+        digests2 = digests2 or file_digests(file_path2, stat2, cache)
+        return 'ignored', digests1[0], digests2[0]
+    if is_binary_file(file_path1, stat1) or is_binary_file(file_path2, stat2):
+        # binary content cannot be diffed line by line, it is hash compared like the --hash extensions
+        digests1 = digests1 or file_digests(file_path1, stat1, cache)
+        digests2 = digests2 or file_digests(file_path2, stat2, cache)
+        return 'ignored', digests1[0], digests2[0]
+    return 'changed', None, None
+
+# row class of each status, used by the stats buttons and the report's row index
+STATUS_CLASSES = {
+    'changed': 'file-changed',
+    'ignored': 'file-ignored',
+    'added': 'file-added',
+    'removed': 'file-removed',
+    'identical': 'file-no-change',
+    'moved': 'file-moved',
+}
+
+class Profiler:
+    """
+    Per-phase timings and counters of one compare_dirs run (--profile): bytes read, files
+    and time per status, a histogram of the time per file and the slowest diffs.
+
+    Phases nest per thread and are exclusive: hashing inside classify and diffing inside render
+    only count as hash and diff, so the byte comparison, hashing, line diff and html assembly
+    can be told apart. Phase times are summed over all workers, so with --jobs they can add up
+    to more than the wall time.
+    """
+    PHASES = ('walk', 'classify', 'hash', 'diff', 'render', 'write')
+    # upper bounds in seconds of the per file time histogram buckets, the last bucket is open
+    HISTOGRAM_BOUNDS = (0.0001, 0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self, top=10):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.local = threading.local()
+        self.bytes_read = 0
+        self.files = dict.fromkeys(STATUS_CLASSES, 0)
+        self.status_seconds = dict.fromkeys(STATUS_CLASSES, 0.0)
+        self.reused_rows = 0
+        self.histogram = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+        self.top = top
+        self.slowest = []
+        # counters of the ComparisonPipeline stages, set when --jobs > 1
+        self.pipeline = None
+
+    def add_phase(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] += seconds
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        stack = self.local.__dict__.setdefault('stack', [])
+        if stack:
+            self.add_phase(stack[-1], now - self.local.mark)
+        stack.append(phase)
+        self.local.mark = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self.add_phase(self.local.stack.pop(), now - self.local.mark)
+        self.local.mark = now
+
+    def add_phases(self, phases):
+        with self.lock:
+            for phase, seconds in phases.items():
+                self.phases[phase] += seconds
+
+    def count_read(self, nbytes):
+        with self.lock:
+            self.bytes_read += nbytes
+
+    def record_file(self, relpath, status, classify_seconds, render_seconds, reused=False):
+        seconds = classify_seconds + render_seconds
+        with self.lock:
+            self.files[status] += 1
+            self.status_seconds[status] += seconds
+            self.reused_rows += reused
+            self.histogram[bisect_left(self.HISTOGRAM_BOUNDS, seconds)] += 1
+            if status == 'changed' and not reused:
+                # min-heap, so the fastest of the slowest diffs is the one replaced
+                item = (render_seconds, relpath)
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, item)
+                elif item > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    def iter_timed(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            st = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_phase(phase, time.perf_counter() - st)
+            yield item
+
+    def to_dict(self):
+        bounds = [f'<{bound}s' for bound in self.HISTOGRAM_BOUNDS] + [f'>={self.HISTOGRAM_BOUNDS[-1]}s']
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'phase_seconds': self.phases,
+            'bytes_read': self.bytes_read,
+            'files': self.files,
+            'status_seconds': self.status_seconds,
+            'reused_rows': self.reused_rows,
+            'file_seconds_histogram': dict(zip(bounds, self.histogram)),
+            'slowest_diffs': [{'path': relpath, 'seconds': seconds} for seconds, relpath in sorted(self.slowest, reverse=True)],
+            'pipeline': self.pipeline,
+        }
+
+    def summary_html(self):
+        profile = self.to_dict()
+        phases = ''.join(f"<tr><td>{phase}</td><td>{seconds:.3f}s</td></tr>" for phase, seconds in profile['phase_seconds'].items())
+        statuses = ''.join(f"<tr><td>{status}</td><td>{profile['files'][status]} files, {seconds:.3f}s</td></tr>" for status, seconds in profile['status_seconds'].items())
+        histogram = ''.join(f"<tr><td>{bucket}</td><td>{count}</td></tr>" for bucket, count in profile['file_seconds_histogram'].items())
+        slowest = ''.join(f"<tr><td>{html.escape(diff['path'])}</td><td>{diff['seconds']:.3f}s</td></tr>" for diff in profile['slowest_diffs'])
+        pipeline = ''.join(f"<tr><td>{stage}</td><td>{counters['items']} items, capacity {counters['capacity_per_second']:.1f}/s, queue max {counters['max_queue_depth']}</td></tr>" for stage, counters in (profile['pipeline'] or {}).items())
+        return f"""
+            <details id="profile-summary" style="flex-basis: 100%; padding: 10px;">
+                <summary>Profile: {profile['total_seconds']:.3f}s, {sizeof_fmt(profile['bytes_read'])} read, {profile['reused_rows']} rows reused</summary>
+                <div style="display: flex; justify-content: space-around; align-items: flex-start;">
+                    <table class='no-border'><tr><th colspan='2'>Phase</th></tr>{phases}</table>
+                    <table class='no-border'><tr><th colspan='2'>Status</th></tr>{statuses}</table>
+                    <table class='no-border'><tr><th colspan='2'>Time per file</th></tr>{histogram}</table>
+                    <table class='no-border'><tr><th colspan='2'>Slowest diffs</th></tr>{slowest}</table>
+                    {f"<table class='no-border'><tr><th colspan='2'>Pipeline</th></tr>{pipeline}</table>" if pipeline else ''}
+                </div>
+            </details>
+        """
+
+# set by compare_dirs while a --profile run is in progress, so the readers can count bytes
+active_profiler = None
+
+@contextlib.contextmanager
+def profile_phase(phase):
+    """Count the time spent in the block as `phase` of the active profiler, if any."""
+    if active_profiler is None:
+        yield
+        return
+    profiler = active_profiler
+    profiler.enter(phase)
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+# how rows are rendered, passed as one picklable value to the diff worker processes
+RenderOptions = namedtuple('RenderOptions', 'nlines diff_algorithm intraline_max_lines report_mode shard_dir max_diff_bytes max_diff_lines diff_timeout archive_members output_format record_diffs', defaults=(3, 'difflib', 200, 'inline', '', 0, 0, 0, True, 'html', False))
+
+def write_diff_shard(shard_dir, relpath, cells):
+    # shards are small scripts rather than JSON so they also load from file:// URLs
+    shard_id = 'd' + hashlib.sha1(relpath.encode('utf8')).hexdigest()[:16]
+    with open(os.path.join(shard_dir, f'{shard_id}.js'), 'w', encoding='utf8') as f:
+        f.write(f"registerDiffShard('{shard_id}', {json.dumps(cells)});\n")
+    return shard_id
+
+def summarize_content(file_path, file_stat, chunk_size=1024 * 1024):
+    """Return the (md5, line count) of a file in one streamed pass, for changed files whose diff is not rendered."""
+    md5, line_count, last_byte = hashlib.md5(), 0, b'\n'
+    if isinstance(file_stat, ManifestStat):
+        chunks = [decompress_content(file_stat.codec, file_stat.content)]
+    else:
+        f = open(file_path, 'rb')
+        chunks = iter(lambda: f.read(chunk_size), b'')
+    for chunk in chunks:
+        md5.update(chunk)
+        line_count += chunk.count(b'\n')
+        last_byte = chunk[-1:]
+    if not isinstance(file_stat, ManifestStat):
+        f.close()
+    return md5.hexdigest(), line_count + (last_byte != b'\n')
+
+def render_truncated_diff_row(file_path1, file_path2, stat1, stat2, file_path_td, reason, row_class='file-changed'):
+    with profile_phase('hash'):
+        md5_hash1, line_count1 = summarize_content(file_path1, stat1)
+        md5_hash2, line_count2 = summarize_content(file_path2, stat2)
+    note = f"<div class='truncated'>Diff truncated: {reason}, lines {line_count2 - line_count1:+d}</div>"
+    return f"<tr class='{row_class} diff-truncated'><td class='small'></td>{file_path_td}<td class='twenty'>{note}{get_file_properties_table(file_path1, md5_hash=md5_hash1, file_stat=stat1, line_count=line_count1)}</td><td class='twenty'>{note}{get_file_properties_table(file_path2, md5_hash=md5_hash2, file_stat=stat2, line_count=line_count2)}</td></tr>"
+
+def render_diff_lines(diff):
+    """Turn UnifiedDiffer output into the html lines of the left and right side."""
+    diff1, diff2 = [], []
+    last_change_line = None
+    for line in diff:
+        if line.startswith('---') or line.startswith('+++'):
+            pass
+        elif line.startswith('@@'):
+            hunk_header = f"<hr><span class='hk'>&nbsp;{html.escape(line)}</span><br>"
+            diff1.append(hunk_header)
+            diff2.append(hunk_header)
+        elif line.startswith('+'):
+            last_change_line = line
+            diff1.append(f"{get_ruler_span()}<span class='u'>{html.escape(line[1:])}</span>")
+            diff2.append(f"{get_ruler_span(line[0])}<span class='la'>{html.escape(line[1:])}</span>")
+        elif line.startswith('-'):
+            last_change_line = line
+            diff1.append(f"{get_ruler_span(line[0])}<span class='ld'>{html.escape(line[1:])}</span>")
+            diff2.append(f"{get_ruler_span()}<span class='u'>{html.escape(line[1:])}</span>")
+        elif line.startswith('?') and line[1:].strip() != '':
+            # only used for custom mode
+            if last_change_line[0] == '+':
+                diff2.pop()
+                diff2.append(f"{get_ruler_span(last_change_line[0])}<span class='la'>{merge_str_diff(last_change_line[1:], line[1:])}</span>")
+            elif last_change_line[0] == '-':
+                diff1.pop()
+                diff1.append(f"{get_ruler_span(last_change_line[0])}<span class='ld'>{merge_str_diff(last_change_line[1:], line[1:])}</span>")
+        else:
+            text = f"{get_ruler_span('=')}{html.escape(line[1:])}"
+            diff1.append(text)
+            diff2.append(text)
+    return diff1, diff2
+
+ARCHIVE_EXTENSIONS = ('zip', 'jar', 'war', 'ear')
+
+def is_archive(file_path):
+    return os.path.splitext(file_path)[1][1:].lower() in ARCHIVE_EXTENSIONS
+
+def get_member_summary(info):
+    return f"{sizeof_fmt(info.file_size)}, CRC32 {info.CRC:08x}"
+
+def budgeted_diff(size, read_lines, render_options, kind='files', intraline_max_lines=None, **diff_args):
+    """
+    UnifiedDiffer lines of the two lists of lines returned by read_lines(), within the --max-diff-bytes,
+    --max-diff-lines and --diff-timeout budgets: returns (diff, None), or (None, reason) when over one.
+    `size` is the bytes of both sides together and `kind` names them in the reason. read_lines() may
+    return None for content that is not diffed (binary), which gives (None, None).
+    """
+    deadline = time.monotonic() + render_options.diff_timeout if render_options.diff_timeout else None
+    if render_options.max_diff_bytes and size > render_options.max_diff_bytes:
+        return None, f'{kind} are larger than {sizeof_fmt(render_options.max_diff_bytes)} together'
+    lines = read_lines()
+    if lines is None:
+        return None, None
+    lines1, lines2 = lines
+    if render_options.max_diff_lines and len(lines1) + len(lines2) > render_options.max_diff_lines:
+        return None, f'{kind} have more than {render_options.max_diff_lines} lines together'
+
+    if intraline_max_lines is None:
+        intraline_max_lines = render_options.intraline_max_lines
+    differ = UnifiedDiffer(matcher=DIFF_MATCHERS[render_options.diff_algorithm], intraline_max_lines=intraline_max_lines, deadline=deadline)
+    try:
+        with profile_phase('diff'):
+            return list(differ.unified_diff(lines1, lines2, lineterm='', n=render_options.nlines, **diff_args)), None
+    except DiffTimeout:
+        return None, f'diff took longer than {render_options.diff_timeout}s'
+
+def read_member_lines(archive1, info1, archive2, info2):
+    # only the first block is inflated to tell binary members, which are never read in full
+    if is_binary_member(archive1, info1) or is_binary_member(archive2, info2):
+        return None
+    return FileContent(archive1.read(info1)).lines(), FileContent(archive2.read(info2)).lines()
+
+def is_binary_member(archive, info):
+    with archive.open(info) as f:
+        return sniff_encoding(f.read(BINARY_SNIFF_SIZE)) is None
+
+def render_member_diff(archive1, info1, archive2, info2, render_options):
+    summary1, summary2 = get_member_summary(info1), get_member_summary(info2)
+    diff, truncated = budgeted_diff(info1.file_size + info2.file_size, lambda: read_member_lines(archive1, info1, archive2, info2), render_options, 'members')
+    if truncated is not None:
+        note = f"<div class='truncated'>Diff truncated: {truncated}</div>"
+        return note + summary1, note + summary2
+    if diff is None:
+        return summary1, summary2
+    diff1, diff2 = render_diff_lines(diff)
+    return summary1 + '<br>'.join(diff1), summary2 + '<br>'.join(diff2)
+
+# nested archives up to this size are inflated in memory, larger ones into a temporary file
+NESTED_ARCHIVE_SPOOL_SIZE = 16 * 1024 * 1024
+
+@contextlib.contextmanager
+def open_nested_archive(archive, info):
+    with tempfile.SpooledTemporaryFile(max_size=NESTED_ARCHIVE_SPOOL_SIZE) as spool:
+        with archive.open(info) as member:
+            shutil.copyfileobj(member, spool)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as nested:
+            yield nested
+
+def render_archive_member_rows(archive1, archive2, render_options, prefix=''):
+    """
+    Match the members of two open zip archives by name and compare them by the CRC32 and
+    size of their central directory entries, so identical members are never decompressed.
+    Only differing members are read: nested archives are compared the same way, text
+    members are diffed and others summarized. Returns (html rows, member counts by status).
+    """
+    infos1 = {info.filename: info for info in archive1.infolist() if not info.is_dir()}
+    infos2 = {info.filename: info for info in archive2.infolist() if not info.is_dir()}
+    rows, counts = [], dict.fromkeys(('changed', 'added', 'removed', 'identical'), 0)
+    for name in sorted(infos1.keys() | infos2.keys()):
+        info1, info2 = infos1.get(name), infos2.get(name)
+        member_path = html.escape(prefix + name)
+        if info1 is None:
+            counts['added'] += 1
+            rows.append(f"<tr class='file-added'><td>{member_path}</td><td></td><td>{get_member_summary(info2)}</td></tr>")
+        elif info2 is None:
+            counts['removed'] += 1
+            rows.append(f"<tr class='file-removed'><td>{member_path}</td><td>{get_member_summary(info1)}</td><td></td></tr>")
+        elif (info1.CRC, info1.file_size) == (info2.CRC, info2.file_size):
+            counts['identical'] += 1
+        else:
+            if is_archive(name):
+                try:
+                    with open_nested_archive(archive1, info1) as nested1, open_nested_archive(archive2, info2) as nested2:
+                        nested_rows, nested_counts = render_archive_member_rows(nested1, nested2, render_options, f'{prefix}{name}!/')
+                    rows += nested_rows
+                    for status, count in nested_counts.items():
+                        counts[status] += count
+                    continue
+                except zipfile.BadZipFile:
+                    pass
+            counts['changed'] += 1
+            cell1, cell2 = render_member_diff(archive1, info1, archive2, info2, render_options)
+            rows.append(f"<tr class='file-changed'><td>{member_path}</td><td>{cell1}</td><td>{cell2}</td></tr>")
+    return rows, counts
+
+def render_archive_row(file_path1, file_path2, stat1, stat2, file_path_td, render_options):
+    """Row of an archive pair listing its differing members, or None if either side is not a readable zip."""
+    try:
+        with zipfile.ZipFile(file_path1) as archive1, zipfile.ZipFile(file_path2) as archive2:
+            rows, counts = render_archive_member_rows(archive1, archive2, render_options)
+    except (zipfile.BadZipFile, OSError):
+        return None
+    summary = f"Archive members: {counts['changed']} changed, {counts['added']} added, {counts['removed']} removed, {counts['identical']} identical"
+    if not rows:
+        summary += ', only archive metadata such as timestamps differs'
+    members_table = f"<table class='archive-members'>{''.join(rows)}</table>" if rows else ''
+    return f"<tr class='file-ignored'><td class='small'></td>{file_path_td}<td class='twenty' colspan='2'><div class='archive-properties'>{get_file_properties_table(file_path1, file_stat=stat1)}{get_file_properties_table(file_path2, file_stat=stat2)}</div><div class='truncated'>{summary}</div>{members_table}</td></tr>"
+
+def render_file_pair_row(classification, file_path1, file_path2, stat1, stat2, file_path_td, dir1, dir2, render_options=RenderOptions(), cache=None, row_class='file-changed'):
+    status, md5_hash1, md5_hash2 = classification
+    if status == 'added':
+        return f"<tr class='file-added'><td class='small'></td>{file_path_td}<td class='twenty center' colspan='2'><span>Added in '{dir2}'</span></td></tr>"
+    if status == 'removed':
+        return f"<tr class='file-removed'><td class='small'></td>{file_path_td}<td class='twenty center' colspan='2'><span>Removed from '{dir2}'</span></td></tr>"
+    if status == 'identical':
+        return f"<tr class='file-no-change'><td class='small'></td>{file_path_td}<td class='twenty center' colspan='2'><span>No change</span></td></tr>"
+    if status == 'ignored':
+        if render_options.archive_members and is_archive(file_path1) and not isinstance(stat1, ManifestStat) and not isinstance(stat2, ManifestStat):
+            row = render_archive_row(file_path1, file_path2, stat1, stat2, file_path_td, render_options)
+            if row is not None:
+                return row
+        # archives are not hashed when classified, see classify_file_pair
+        md5_hash1 = md5_hash1 or file_digests(file_path1, stat1, cache)[0]
+        md5_hash2 = md5_hash2 or file_digests(file_path2, stat2, cache)[0]
+        return f"<tr class='file-ignored'><td class='small'></td>{file_path_td}<td class='twenty'><span>{get_file_properties_table(file_path1, md5_hash=md5_hash1, file_stat=stat1)}</span></td><td class='twenty'><span>{get_file_properties_table(file_path2, md5_hash=md5_hash2, file_stat=stat2)}</span></td></tr>"
+
+    # files over the diff budget get a summary row instead, so one pair cannot stall the whole run
+    diff, truncated = budgeted_diff(stat1.st_size + stat2.st_size, lambda: (read_lines(file_path1, stat1), read_lines(file_path2, stat2)), render_options, fromfile=file_path1, tofile=file_path2)
+    if truncated is not None:
+        return render_truncated_diff_row(file_path1, file_path2, stat1, stat2, file_path_td, truncated, row_class)
+    diff1, diff2 = render_diff_lines(diff)
+    cell1 = f"""
+            {get_file_properties_table(file_path1, file_stat=stat1)}
+            {'<br>'.join(diff1)}
+    """
+    cell2 = f"""
+            {get_file_properties_table(file_path2, file_stat=stat2)}
+            {'<br>'.join(diff2)}
+    """
+
+    if render_options.report_mode == 'sharded':
+        # the diff is only loaded into the page when the row is expanded
+        shard_id = write_diff_shard(render_options.shard_dir, os.path.relpath(file_path1, dir1), [cell1, cell2])
+        return f"""
+    <tr class='{row_class}' data-shard='{os.path.basename(render_options.shard_dir)}/{shard_id}.js' data-shard-id='{shard_id}'>
+        <td class='small'><span class="collapse-icon" onclick="toggleRow(this.parentElement.parentElement, this)">[+]</span></td>
+        {file_path_td}
+        <td class='twenty' style='display: none'></td>
+        <td class='twenty' style='display: none'></td>
+    </tr>
+    """
+
+    return f"""
+    <tr class='{row_class}'>
+        <td class='small'><span class="collapse-icon" onclick="toggleRow(this.parentElement.parentElement, this)">[-]</span></td>
+        {file_path_td}
+        <td class='twenty'>{cell1}</td>
+        <td class='twenty'>{cell2}</td>
+    </tr>
+    """
+
+def diff_record(file_path1, file_path2, stat1, stat2, render_options=RenderOptions()):
+    """The 'diff' of a changed file's record, or its 'diff_truncated' reason when it is over the diff budget."""
+    # plain unified diff text without intraline matching, its '?' hints are only used by the html report
+    diff, truncated = budgeted_diff(stat1.st_size + stat2.st_size, lambda: (read_lines(file_path1, stat1), read_lines(file_path2, stat2)), render_options, intraline_max_lines=0, fromfile=file_path1, tofile=file_path2)
+    if truncated is not None:
+        return {'diff_truncated': truncated}
+    # the differ writes lines the Differ way ('- ' prefix) and replaced blocks shorter side first,
+    # patch tools expect a one character prefix and the removed lines first
+    body = [line if line.startswith('@@') else line[0] + line[2:] for line in diff[2:] if not line.startswith('?')]
+    runs = groupby(body, key=lambda line: line[0] in '+-')
+    body = [line for changed, run in runs for line in (sorted(run, key=lambda line: line[0] == '+') if changed else run)]
+    # only hunk headers lack a newline, a last line without one gets patch's marker instead
+    lines = [line + '\n' for line in diff[:2]]
+    lines += [line + '\n' if line.startswith('@@') else line if line.endswith('\n') else line + '\n\\ No newline at end of file\n' for line in body]
+    return {'diff': ''.join(lines)}
+
+def render_file_pair_record(classification, file_path1, file_path2, stat1, stat2, file_path_td, dir1, dir2, render_options=RenderOptions(), cache=None):
+    """
+    --format ndjson/json counterpart of render_file_pair_row: the file's record as one line of JSON.
+    Only digests already computed while classifying are included, nothing is hashed for the record.
+    """
+    status, md5_hash1, md5_hash2 = classification
+    record = {
+        'path': os.path.normpath(os.path.relpath(file_path1, dir1)),
+        'status': status,
+        'size1': stat1.st_size if stat1 is not None else None,
+        'size2': stat2.st_size if stat2 is not None else None,
+    }
+    if md5_hash1 or md5_hash2:
+        record['md5'] = [md5_hash1, md5_hash2]
+    if status == 'changed' and render_options.record_diffs:
+        record.update(diff_record(file_path1, file_path2, stat1, stat2, render_options))
+    return json.dumps(record)
+
+def render_file_pair(classification, file_path1, file_path2, stat1, stat2, file_path_td, dir1, dir2, render_options=RenderOptions(), cache=None):
+    """The html table row or, with --format ndjson/json, the record of a file pair."""
+    with profile_phase('render'):
+        if render_options.output_format == 'html':
+            return render_file_pair_row(classification, file_path1, file_path2, stat1, stat2, file_path_td, dir1, dir2, render_options, cache)
+        return render_file_pair_record(classification, file_path1, file_path2, stat1, stat2, file_path_td, dir1, dir2, render_options, cache)
+
+def render_file_pair_profiled(*args):
+    """render_file_pair in a diff worker process of a --profile run, also returning the worker's phase times."""
+    global active_profiler
+    active_profiler = Profiler()
+    try:
+        return render_file_pair(*args), active_profiler.phases
+    finally:
+        active_profiler = None
+
+class ComparisonState(BufferedStore):
+    """
+    SQLite backed store of the rows of previous runs, for incremental re-compares (--state-file).
+
+    Rows are keyed by a fingerprint of the comparison (directories and rendering options) and
+    the relative path, and are only reused while the (size, mtime, inode) signatures of both
+    sides and the rendered file path cell still match. Rows of paths not seen again in a run
+    are dropped on close, so one state file can serve several comparisons.
+    """
+    VERSION = 1
+
+    def __init__(self, state_file, dir1, dir2, ignore_file_extensions, render_options):
+        state_dir = os.path.dirname(os.path.abspath(state_file))
+        os.makedirs(state_dir, exist_ok=True)
+        options = [self.VERSION, os.path.abspath(dir1), os.path.abspath(dir2), sorted(ignore_file_extensions), *render_options._replace(shard_dir=os.path.abspath(render_options.shard_dir) if render_options.shard_dir else '')]
+        self.fingerprint = hashlib.sha1(json.dumps(options).encode()).hexdigest()
+        super().__init__()
+        self.run_id = time.time_ns()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(state_file, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rows (fingerprint TEXT, path TEXT, signature TEXT, status TEXT, row TEXT, run_id INTEGER, PRIMARY KEY (fingerprint, path))')
+        self.conn.commit()
+
+    @staticmethod
+    def signature(pair):
+        file_stats = [(file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino) if file_stat else None for file_stat in pair[2:4]]
+        return json.dumps([*file_stats, pair[4]])
+
+    def get(self, relpath, pair):
+        with self.lock:
+            row = self.conn.execute('SELECT signature, status, row FROM rows WHERE fingerprint = ? AND path = ?', (self.fingerprint, relpath)).fetchone()
+            if row is None or row[0] != self.signature(pair):
+                return None
+            self.used[relpath] = self.run_id
+            self._written()
+            return row[1], row[2]
+
+    def put(self, relpath, pair, status, row):
+        # same as the digest cache, files modified this recently may still change within the same mtime tick
+        if any(file_stat and time.time_ns() - file_stat.st_mtime_ns < DigestCache.MTIME_GRACE_NS for file_stat in pair[2:4]):
+            return
+        with self.lock:
+            self.pending[relpath] = (self.fingerprint, relpath, self.signature(pair), status, row, self.run_id)
+            self._written()
+
+    def _write(self, rows, used):
+        self.conn.executemany('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.executemany('UPDATE rows SET run_id = ? WHERE fingerprint = ? AND path = ?', [(run_id, self.fingerprint, relpath) for relpath, run_id in used])
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.execute('DELETE FROM rows WHERE fingerprint = ? AND run_id != ?', (self.fingerprint, self.run_id))
+            self.conn.commit()
+            self.conn.close()
+
+def iter_file_pairs(dir1, dir2, file_tags_index, path_filter=None, path_cells=True):
+    # records (--format ndjson/json) have no file path cell
+    for relpath, entry1, entry2 in walk_dirs(dir1, dir2, path_filter=path_filter):
+        file_path1 = os.path.join(dir1, relpath)
+        file_path2 = os.path.join(dir2, relpath)
+        stat1 = stat_entry(entry1) if entry1 else None
+        stat2 = stat_entry(entry2) if entry2 else None
+        if stat1 is None and stat2 is None:
+            continue
+
+        file_path_td = generate_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_index) if path_cells else ''
+        yield (file_path1, file_path2, stat1, stat2, file_path_td)
+
+def start_file_pair(pair, dir1, ignore_file_extensions=[], cache=None, state=None, profiler=None):
+    """
+    First half of compare_file_pair: returns (relpath, started, cached, classification), where
+    cached is the (status, row) reused from the state file, and otherwise the classification is set.
+    """
+    relpath = os.path.relpath(pair[0], dir1)
+    started = time.perf_counter() if profiler is not None else None
+    with profile_phase('classify'):
+        if state is not None:
+            cached = state.get(relpath, pair)
+            if cached is not None:
+                if profiler is not None:
+                    profiler.record_file(relpath, cached[0], time.perf_counter() - started, 0.0, reused=True)
+                return relpath, started, cached, None
+        return relpath, started, None, classify_file_pair(*pair[:4], ignore_file_extensions, cache)
+
+def finish_file_pair(pair, relpath, started, classified, classification, row, state=None, profiler=None):
+    if profiler is not None:
+        if classification[0] == 'changed':
+            # the diff reads both files in full
+            profiler.count_read(pair[2].st_size + pair[3].st_size)
+        profiler.record_file(relpath, classification[0], classified - started, time.perf_counter() - classified)
+    if state is not None:
+        state.put(relpath, pair, classification[0], row)
+    return classification[0], row
+
+def compare_file_pair(pair, dir1, dir2, ignore_file_extensions=[], cache=None, render_options=RenderOptions(), state=None, profiler=None):
+    relpath, started, cached, classification = start_file_pair(pair, dir1, ignore_file_extensions, cache, state, profiler)
+    if cached is not None:
+        return cached
+    classified = time.perf_counter() if profiler is not None else None
+    row = render_file_pair(classification, *pair, dir1, dir2, render_options, cache)
+    return finish_file_pair(pair, relpath, started, classified, classification, row, state, profiler)
+
+class PipelineStage:
+    """Counters of one ComparisonPipeline stage: items done, time spent on them and the depth of its input queue."""
+
+    def __init__(self, input_queue=None, workers=1):
+        self.input_queue = input_queue
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def done(self, seconds):
+        with self.lock:
+            self.items += 1
+            self.busy_seconds += seconds
+            if self.input_queue is not None:
+                self.max_queue_depth = max(self.max_queue_depth, self.input_queue.qsize())
+
+    def counters(self):
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy_seconds': self.busy_seconds,
+            # of all the stage's workers together while busy, so the bottleneck stage shows up with the lowest capacity
+            'capacity_per_second': self.items * self.workers / self.busy_seconds if self.busy_seconds else 0.0,
+            'queue_depth': self.input_queue.qsize() if self.input_queue is not None else 0,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+class ComparisonPipeline:
+    """
+    compare_file_pairs for --jobs > 1, as stages connected by bounded queues:
+
+        walker (1 thread) -> classifier (classify_jobs threads: stat, size and byte comparison, hashing)
+        -> differ (diff_jobs processes: diff and html or record of changed files and archives) -> writer (the consumer of run())
+
+    Rows of other statuses, and records without --record-diffs, are rendered by the classifier right away. The writer gets the rows
+    in walk order, and at most queue_size pairs are in flight anywhere in the pipeline, which
+    also bounds the reorder buffer. A slow diff therefore only stalls the walk once the whole
+    window is waiting on it.
+    """
+
+    def __init__(self, dir1, dir2, file_tags_index, ignore_file_extensions=[], cache=None, render_options=RenderOptions(), state=None, profiler=None, classify_jobs=1, diff_jobs=1, queue_size=16, path_filter=None):
+        self.dir1, self.dir2 = dir1, dir2
+        self.path_filter = path_filter
+        self.file_tags_index = file_tags_index
+        self.ignore_file_extensions = ignore_file_extensions
+        self.cache = cache
+        self.render_options = render_options
+        self.state = state
+        self.profiler = profiler
+        self.classify_jobs, self.diff_jobs = classify_jobs, diff_jobs
+        self.classify_queue = queue.Queue(queue_size)
+        self.diff_queue = queue.Queue(queue_size)
+        self.results = queue.Queue()
+        self.in_flight = threading.Semaphore(queue_size)
+        self.queue_size = queue_size
+        self.cancelled = threading.Event()
+        self.classifiers_left = classify_jobs
+        self.lock = threading.Lock()
+        self.stages = {
+            'walk': PipelineStage(),
+            'classify': PipelineStage(self.classify_queue, classify_jobs),
+            'diff': PipelineStage(self.diff_queue, diff_jobs),
+            'write': PipelineStage(self.results),
+        }
+
+    def counters(self):
+        return {name: stage.counters() for name, stage in self.stages.items()}
+
+    def needs_diff(self, pair, classification):
+        """Whether the row is rendered by the diff processes: changed files, and archives whose members are diffed."""
+        status = classification[0]
+        if self.render_options.output_format != 'html':
+            return status == 'changed' and self.render_options.record_diffs
+        return status == 'changed' or (status == 'ignored' and self.render_options.archive_members and is_archive(pair[0]))
+
+    def walk(self):
+        try:
+            pairs = iter_file_pairs(self.dir1, self.dir2, self.file_tags_index, self.path_filter, self.render_options.output_format == 'html')
+            if self.profiler is not None:
+                pairs = self.profiler.iter_timed('walk', pairs)
+            seq = 0
+            st = time.perf_counter()
+            for pair in pairs:
+                self.stages['walk'].done(time.perf_counter() - st)
+                self.in_flight.acquire()
+                if self.cancelled.is_set():
+                    return
+                self.classify_queue.put((seq, pair))
+                seq += 1
+                st = time.perf_counter()
+            self.results.put(('count', seq))
+        except BaseException as e:
+            self.results.put(('error', e))
+        finally:
+            for _ in range(self.classify_jobs):
+                self.classify_queue.put(None)
+
+    def classify(self):
+        while (item := self.classify_queue.get()) is not None:
+            if self.cancelled.is_set():
+                continue
+            seq, pair = item
+            try:
+                st = time.perf_counter()
+                relpath, started, cached, classification = start_file_pair(pair, self.dir1, self.ignore_file_extensions, self.cache, self.state, self.profiler)
+                classified = time.perf_counter()
+                if cached is not None:
+                    self.results.put(('row', seq, pair, cached))
+                elif self.needs_diff(pair, classification):
+                    self.diff_queue.put((seq, pair, relpath, started, classified, classification))
+                else:
+                    row = render_file_pair(classification, *pair, self.dir1, self.dir2, self.render_options, self.cache)
+                    self.results.put(('row', seq, pair, finish_file_pair(pair, relpath, started, classified, classification, row, self.state, self.profiler)))
+                self.stages['classify'].done(time.perf_counter() - st)
+            except BaseException as e:
+                self.results.put(('error', e))
+        with self.lock:
+            self.classifiers_left -= 1
+            if self.classifiers_left == 0:
+                for _ in range(self.diff_jobs):
+                    self.diff_queue.put(None)
+
+    def diff(self, process_pool):
+        while (item := self.diff_queue.get()) is not None:
+            if self.cancelled.is_set():
+                continue
+            seq, pair, relpath, started, classified, classification = item
+            try:
+                st = time.perf_counter()
+                if self.profiler is not None:
+                    # the wait in diff_queue counts as neither classify nor render time of the file
+                    started, classified = started + st - classified, st
+                    row, phases = process_pool.submit(render_file_pair_profiled, classification, *pair, self.dir1, self.dir2, self.render_options).result()
+                    self.profiler.add_phases(phases)
+                else:
+                    row = process_pool.submit(render_file_pair, classification, *pair, self.dir1, self.dir2, self.render_options).result()
+                self.results.put(('row', seq, pair, finish_file_pair(pair, relpath, started, classified, classification, row, self.state, self.profiler)))
+                self.stages['diff'].done(time.perf_counter() - st)
+            except BaseException as e:
+                self.results.put(('error', e))
+
+    def run(self):
+        """Yield (pair, status, table row html) in walk order, like compare_file_pairs."""
+        # the pool starts its workers on demand, once the stage threads already run and may hold locks,
+        # so they are not forked from this process
+        mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        with ProcessPoolExecutor(max_workers=self.diff_jobs, mp_context=mp_context) as process_pool:
+            threads = [threading.Thread(target=self.walk, daemon=True)]
+            threads += [threading.Thread(target=self.classify, daemon=True) for _ in range(self.classify_jobs)]
+            threads += [threading.Thread(target=self.diff, args=(process_pool,), daemon=True) for _ in range(self.diff_jobs)]
+            for thread in threads:
+                thread.start()
+
+            pending, next_seq, total = {}, 0, None
+            try:
+                while total is None or next_seq < total:
+                    if next_seq in pending:
+                        pair, (status, row) = pending.pop(next_seq)
+                        st = time.perf_counter()
+                        yield pair, status, row
+                        self.stages['write'].done(time.perf_counter() - st)
+                        self.in_flight.release()
+                        next_seq += 1
+                        continue
+                    message = self.results.get()
+                    if message[0] == 'row':
+                        pending[message[1]] = message[2:]
+                    elif message[0] == 'count':
+                        total = message[1]
+                    else:
+                        raise message[1]
+            finally:
+                # on an error or an abandoned generator, let every stage drain its queue and stop
+                self.cancelled.set()
+                self.in_flight.release(self.queue_size)
+                for thread in threads:
+                    thread.join()
+                if self.profiler is not None:
+                    self.profiler.pipeline = self.counters()
+
+def compare_file_pairs(dir1, dir2, file_tags_index, ignore_file_extensions=[], jobs=1, cache=None, render_options=RenderOptions(), state=None, profiler=None, classify_jobs=0, diff_jobs=0, queue_size=0, path_filter=None):
+    """
+    Yield (pair, status, table row html or record) for every file found in dir1 or dir2, in walk order.
+    With jobs > 1 the pairs go through a ComparisonPipeline, classify_jobs, diff_jobs and
+    queue_size default to jobs, jobs and jobs * 4.
+    """
+    if jobs <= 1:
+        pairs = iter_file_pairs(dir1, dir2, file_tags_index, path_filter, render_options.output_format == 'html')
+        if profiler is not None:
+            pairs = profiler.iter_timed('walk', pairs)
+        for pair in pairs:
+            yield pair, *compare_file_pair(pair, dir1, dir2, ignore_file_extensions, cache, render_options, state, profiler)
+        return
+
+    pipeline = ComparisonPipeline(dir1, dir2, file_tags_index, ignore_file_extensions, cache, render_options, state, profiler, classify_jobs or jobs, diff_jobs or jobs, queue_size or jobs * 4, path_filter)
+    yield from pipeline.run()
+
+def find_exact_moves(removed, added, cache=None):
+    """
+    Pair removed and added files with the same content. Files are grouped by size first and
+    only sizes present on both sides are hashed, preferring pairs with the same file name.
+    `removed` and `added` are lists of (file_path, file_stat), returns (removed index, added index) pairs.
+    """
+    removed_by_size = {}
+    for i, (file_path, file_stat) in enumerate(removed):
+        removed_by_size.setdefault(file_stat.st_size, []).append(i)
+    added_by_size = {}
+    for j, (file_path, file_stat) in enumerate(added):
+        if file_stat.st_size in removed_by_size:
+            added_by_size.setdefault(file_stat.st_size, []).append(j)
+
+    matches = []
+    for size, added_indexes in added_by_size.items():
+        removed_by_digest = {}
+        for i in removed_by_size[size]:
+            removed_by_digest.setdefault(file_digests(*removed[i], cache)[1], []).append(i)
+        for j in added_indexes:
+            candidates = removed_by_digest.get(file_digests(*added[j], cache)[1])
+            if not candidates:
+                continue
+            name = os.path.basename(added[j][0])
+            i = next((i for i in candidates if os.path.basename(removed[i][0]) == name), candidates[0])
+            candidates.remove(i)
+            matches.append((i, j))
+    return matches
+
+MINHASH_PRIME = (1 << 61) - 1
+def minhash_coefficients(count=64, seed=0):
+    # one seeded generator draws every (a, b), so the hash functions are independent and the same in every run
+    rnd = random.Random(seed)
+    return [(rnd.randrange(1, MINHASH_PRIME), rnd.randrange(MINHASH_PRIME)) for _ in range(count)]
+
+MINHASH_COEFFICIENTS = minhash_coefficients()
+MINHASH_BAND_SIZE = 4
+
+def minhash_signature(lines, shingle_size=2):
+    """MinHash of the set of `shingle_size` consecutive lines, equal positions of two signatures estimate their Jaccard similarity."""
+    shingles = {zlib.crc32(''.join(lines[i:i + shingle_size]).encode('utf8', 'replace')) for i in range(max(1, len(lines) - shingle_size + 1))}
+    return [min((a * shingle + b) % MINHASH_PRIME for shingle in shingles) for a, b in MINHASH_COEFFICIENTS]
+
+def find_similar_moves(removed, added, min_similarity, max_size=1024 * 1024, max_bucket_pairs=1000):
+    """
+    Pair removed and added text files whose estimated similarity is at least `min_similarity`,
+    most similar first. Candidates come from locality sensitive hashing of MinHash signatures
+    (files sharing one band of the signature), so not every pair is compared.
+    Returns (removed index, added index, similarity) triples.
+    """
+    def signatures(files):
+        result = {}
+        for i, (file_path, file_stat) in enumerate(files):
+            # empty files all share one signature, and are only paired by find_exact_moves
+            if 0 < file_stat.st_size <= max_size and not is_binary_file(file_path, file_stat):
+                result[i] = minhash_signature(read_lines(file_path, file_stat))
+        return result
+    removed_signatures, added_signatures = signatures(removed), signatures(added)
+
+    buckets = {}
+    for side, side_signatures in enumerate((removed_signatures, added_signatures)):
+        for i, signature in side_signatures.items():
+            for band in range(0, len(signature), MINHASH_BAND_SIZE):
+                buckets.setdefault((band, tuple(signature[band:band + MINHASH_BAND_SIZE])), ([], []))[side].append(i)
+
+    candidates = set()
+    for removed_indexes, added_indexes in buckets.values():
+        # very common bands (e.g. boilerplate) say little and would make this quadratic
+        if len(removed_indexes) * len(added_indexes) <= max_bucket_pairs:
+            candidates.update((i, j) for i in removed_indexes for j in added_indexes)
+
+    scored = []
+    for i, j in candidates:
+        similarity = sum(x == y for x, y in zip(removed_signatures[i], added_signatures[j])) / len(MINHASH_COEFFICIENTS)
+        if similarity >= min_similarity:
+            scored.append((-similarity, i, j))
+    scored.sort()
+
+    matches, used_removed, used_added = [], set(), set()
+    for similarity, i, j in scored:
+        if i not in used_removed and j not in used_added:
+            used_removed.add(i)
+            used_added.add(j)
+            matches.append((i, j, -similarity))
+    return matches
+
+def generate_moved_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_index, note=''):
+    relative_file_path1 = os.path.normpath(os.path.relpath(file_path1, dir1))
+    relative_file_path2 = os.path.normpath(os.path.relpath(file_path2, dir2))
+    file_tags_span_list = [f"<span class='tags'>{tag}</span>" for tag in lookup_file_tags(relative_file_path2, file_tags_index)]
+    return f"<td class='ten'><span class='content' data-fp1='{file_path1}' data-fp2='{file_path2}'>{relative_file_path2}</span><br><span class='moved-from'>moved from {relative_file_path1}{note}</span>{''.join(file_tags_span_list)}</td>"
+
+def match_moved_files(removed, added, dir1, dir2, file_tags_index, cache=None, render_options=RenderOptions(), move_similarity=0):
+    """
+    Post-walk stage of --detect-moves: pair the held back (pair, row) of removed and added
+    files and yield the write_row arguments (index path, status, row, tagged path) of the
+    moved rows (records with --format ndjson/json), then of the removed and added rows left unpaired.
+    """
+    removed_files = [(pair[0], pair[2]) for pair, row in removed]
+    added_files = [(pair[1], pair[3]) for pair, row in added]
+    # exact moves have no similarity
+    matches = [(i, j, None) for i, j in find_exact_moves(removed_files, added_files, cache)]
+    if move_similarity > 0:
+        paired_removed, paired_added = {i for i, j, similarity in matches}, {j for i, j, similarity in matches}
+        rest_removed = [i for i in range(len(removed_files)) if i not in paired_removed]
+        rest_added = [j for j in range(len(added_files)) if j not in paired_added]
+        similar = find_similar_moves([removed_files[i] for i in rest_removed], [added_files[j] for j in rest_added], move_similarity)
+        matches += [(rest_removed[i], rest_added[j], similarity) for i, j, similarity in similar]
+
+    for i, j, similarity in sorted(matches, key=lambda match: added_files[match[1]][0]):
+        (file_path1, stat1), (file_path2, stat2) = removed_files[i], added_files[j]
+        relative_file_path1 = os.path.normpath(os.path.relpath(file_path1, dir1))
+        relative_file_path2 = os.path.normpath(os.path.relpath(file_path2, dir2))
+        if render_options.output_format != 'html':
+            record = {'path': relative_file_path2, 'status': 'moved', 'from': relative_file_path1, 'size1': stat1.st_size, 'size2': stat2.st_size, 'similarity': round(similarity, 3) if similarity is not None else None}
+            if similarity is not None and render_options.record_diffs:
+                record.update(diff_record(file_path1, file_path2, stat1, stat2, render_options))
+            row = json.dumps(record)
+        elif similarity is None:
+            file_path_td = generate_moved_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_index)
+            row = f"<tr class='file-moved'><td class='small'></td>{file_path_td}<td class='twenty center' colspan='2'><span>Moved, no change</span></td></tr>"
+        else:
+            file_path_td = generate_moved_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_index, f', ~{similarity:.0%} similar')
+            row = render_file_pair_row(('changed', None, None), file_path1, file_path2, stat1, stat2, file_path_td, dir1, dir2, render_options, cache, 'file-moved')
+        yield f'{relative_file_path1} -> {relative_file_path2}', 'moved', row, relative_file_path2
+
+    paired_removed, paired_added = {i for i, j, similarity in matches}, {j for i, j, similarity in matches}
+    for i, (pair, row) in enumerate(removed):
+        if i not in paired_removed:
+            yield os.path.normpath(os.path.relpath(pair[0], dir1)), 'removed', row
+    for j, (pair, row) in enumerate(added):
+        if j not in paired_added:
+            yield os.path.normpath(os.path.relpath(pair[0], dir1)), 'added', row
+
+class BrotliWriter(io.RawIOBase):
+    """Binary file object compressing everything written to it with brotli."""
+
+    def __init__(self, file_path):
+        self.file = open(file_path, 'wb')
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(self.compressor.process(bytes(data)))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.write(self.compressor.finish())
+            self.file.close()
+        super().close()
+
+REPORT_COMPRESSION_SUFFIXES = ('.gz', '.br')
+
+def strip_compression_suffix(output_file):
+    for suffix in REPORT_COMPRESSION_SUFFIXES:
+        if output_file.endswith(suffix):
+            return output_file[:-len(suffix)]
+    return output_file
+
+def open_report(output_file):
+    """Open the report for writing, compressed with gzip or brotli when its name ends with .gz or .br, '-' is stdout."""
+    if output_file == '-':
+        # line buffered, so a consumer of the records gets each one as soon as it is written
+        sys.stdout.reconfigure(line_buffering=True)
+        return contextlib.nullcontext(sys.stdout)
+    if output_file.endswith('.gz'):
+        return gzip.open(output_file, 'wt', encoding='utf-8', compresslevel=6)
+    if output_file.endswith('.br'):
+        if brotli is None:
+            raise RuntimeError('Writing a .br report requires the brotli package, install it or use .gz instead.')
+        return io.TextIOWrapper(io.BufferedWriter(BrotliWriter(output_file)), encoding='utf-8')
+    return open(output_file, 'w')
+
+def create_path_filter(dir1, dir2, include=(), exclude=(), ignore_file=''):
+    """PathFilter of the --include/--exclude patterns plus `ignore_file`, or by default the .compareignore of either root, None if there are none."""
+    exclude = list(exclude)
+    ignore_files = [ignore_file] if ignore_file else [os.path.join(directory, '.compareignore') for directory in (dir1, dir2) if directory and os.path.isdir(directory)]
+    for file in ignore_files:
+        if os.path.isfile(file):
+            exclude += read_ignore_file(file)
+    return PathFilter(include, exclude) if include or exclude else None
+
+def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, tags_csv='', jobs=1, cache_dir='', cache_size=1000000, diff_algorithm='difflib', intraline_max_lines=200, manifests=None, report_mode='inline', state_file='', profile=False, profile_top=10, max_diff_bytes=0, max_diff_lines=0, diff_timeout=0, archive_members=True, detect_moves=False, move_similarity=0, classify_jobs=0, diff_jobs=0, queue_size=0, include=(), exclude=(), ignore_file='', output_format='html', record_diffs=False):
     dir1 = os.path.normpath(dir1)
     dir2 = os.path.normpath(dir2)
+    path_filter = create_path_filter(dir1, dir2, include, exclude, ignore_file)
+
+    shard_dir = ''
+    if report_mode == 'sharded' and output_format == 'html':
+        # per-file diffs go next to the report, e.g. report.html -> report_files/
+        shard_dir = os.path.splitext(strip_compression_suffix(output_file))[0] + '_files'
+        os.makedirs(shard_dir, exist_ok=True)
+    render_options = RenderOptions(nlines, diff_algorithm, intraline_max_lines, report_mode, shard_dir, max_diff_bytes, max_diff_lines, diff_timeout, archive_members, output_format, record_diffs)
     tag_files_dict = process_tags_csv(tags_csv)
     all_tags = set()
     for tag, file_list in tag_files_dict.items():
         all_tags.add(tag)
     
-    file_tags_dict = transform_file_tags_dict(tag_files_dict)
+    file_tags_index = transform_file_tags_dict(tag_files_dict)
 
     tag_buttons_html_list = [f"<button onclick='onfilterByTag(this, \"{tag}\")' class='stats-button tags'>{tag}</button>" for tag in all_tags]
     tags_filter_div = f"""
@@ -189,6 +2017,7 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
         'changed': 0,
         'removed': 0,
         'added': 0,
+        'moved': 0,
     }
 
     style = """
@@ -281,7 +2110,63 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
         .file-no-change {
             background:rgba(0,0,255,0.2);
         }
-        .unselectable {
+        .file-moved {
+            background:rgba(255,165,0,0.25);
+        }
+        .moved-from {
+            font-size: smaller;
+        }
+        .center {
+            text-align: center;
+        }
+        .collapse-icon {
+            cursor: pointer;
+        }
+        .r, .ra, .rd {
+            display: inline-block;
+            width: 20px;
+            margin-right: 5px;
+            text-align: center;
+            color: #8080808a;
+        }
+        .ra {
+            color: #008000a0;
+        }
+        .rd {
+            color: #ff000080;
+        }
+        .hk {
+            color: grey;
+        }
+        .la {
+            color: green;
+        }
+        .ld {
+            color: red;
+        }
+        .ia {
+            color: white;
+            background-color: green;
+        }
+        .id {
+            color: white;
+            background-color: red;
+        }
+        .ic {
+            background-color: yellow;
+        }
+        .truncated {
+            font-weight: bold;
+            padding: 5px;
+        }
+        .archive-properties {
+            display: flex;
+            justify-content: space-around;
+        }
+        .archive-members td {
+            vertical-align: top;
+        }
+        .u {
             opacity: 0;
             -moz-user-select: none;
             -khtml-user-select: none;
@@ -300,7 +2185,7 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
     search_bar = """
     <div style="display: block; width: 47.5%">
         <div style="display: inline-block; width: 200px">Search by file path / extn:</div>
-        <input type="text" id="searchInput" list="filePaths" onkeyup="filterRows()" placeholder="Enter your text here...">
+        <input type="text" id="searchInput" list="filePaths" oninput="scheduleFilterRows()" placeholder="Enter your text here...">
         <datalist id="filePaths"></datalist>
     </div>
     """
@@ -321,104 +2206,11 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
                 <th class='twenty'>Directory 1 (old): {dir1}</th>
                 <th class='twenty'>Directory 2 (new): {dir2}</th>
             </thead>
-            <tbody>
+            <tbody></tbody>
+        </table>
+        <template id='comparisonRows'><table><tbody>
         """
-    table_rows = []
-
-    for root1, dirs1, files1 in os.walk(dir1):
-        root2 = root1.replace(dir1, dir2)
-        for file1 in files1:
-            file2 = file1
-            file_path1 = os.path.join(root1, file1)
-            file_path2 = os.path.join(root2, file2)
-
-            file_path_td = generate_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_dict)
-
-            if not os.path.exists(file_path2):
-                stats['removed'] += 1
-                table_rows.append(f"<tr class='file-removed'><td class='small'></td>{file_path_td}<td class='twenty' colspan='2' style='text-align: center;'><span>Removed from '{dir2}'</span></td></tr>")
-                continue
-            
-            if filecmp.cmp(file_path1, file_path2, shallow=False):
-                stats['identical'] += 1
-                table_rows.append(f"<tr class='file-no-change'><td class='small'></td>{file_path_td}<td class='twenty' colspan='2' style='text-align: center;'><span>No change</span></td></tr>")
-            elif os.path.splitext(file_path1)[1][1:] in ignore_file_extensions:
-                stats['ignored'] += 1
-                table_rows.append(f"<tr class='file-ignored'><td class='small'></td>{file_path_td}<td class='twenty'><span>{get_file_properties_table(file_path1, show_md5_hash=True)}</span></td><td class='twenty'><span>{get_file_properties_table(file_path2, show_md5_hash=True)}</span></td></tr>")
-            else:
-                stats['changed'] += 1
-                with open(file_path1, encoding='utf8') as f1, open(file_path2, encoding='utf8') as f2:
-                    diff1, diff2 = [], []
-                    diff = list(UnifiedDiffer().unified_diff(f1.readlines(), f2.readlines(), fromfile=file_path1, tofile=file_path2, lineterm='', n=nlines))
-                    # diff = list(difflib.unified_diff(f1.readlines(), f2.readlines(), fromfile=file_path1, tofile=file_path2, lineterm='', n=nlines)) 
-                    last_change_line = None
-                    for line in diff:
-                        if line.startswith('---') or line.startswith('+++'):
-                            pass
-                        elif line.startswith('@@'):
-                            diff1.append(f"<hr><span style='color: grey;'>&nbsp;{html.escape(line)}</span><br>")
-                            diff2.append(f"<hr><span style='color: grey;'>&nbsp;{html.escape(line)}</span><br>")
-                        elif line.startswith('+'):
-                            last_change_line = line
-                            diff1.append(f'{get_ruler_span()}<span class="unselectable">{html.escape(line[1:])}</span>')
-                            diff2.append(f"{get_ruler_span(line[0], '#008000a0')}<span style='color: green;'>{html.escape(line[1:])}</span>")
-                        elif line.startswith('-'):
-                            last_change_line = line
-                            diff1.append(f"{get_ruler_span(line[0], '#ff000080')}<span style='color: red;'>{html.escape(line[1:])}</span>")
-                            diff2.append(f'{get_ruler_span()}<span class="unselectable">{html.escape(line[1:])}</span>')
-                        elif line.startswith('?') and line[1:].strip() != '':
-                            # only used for custom mode
-                            if last_change_line[0] == '+':
-                                diff2.pop()
-                                diff2.append(f"{get_ruler_span(last_change_line[0], '#008000a0')}<span style='color: green;'>{merge_str_diff(last_change_line[1:], line[1:])}</span>")
-                            elif last_change_line[0] == '-':
-                                diff1.pop()
-                                diff1.append(f"{get_ruler_span(last_change_line[0], '#ff000080')}<span style='color: red;'>{merge_str_diff(last_change_line[1:], line[1:])}</span>")
-                        else:
-                            text = f"{get_ruler_span('=')}{html.escape(line[1:])}"
-                            diff1.append(text)
-                            diff2.append(text)
-                    table_rows.append(f"""
-                    <tr class='file-changed'>
-                        <td class='small'><span class="collapse-icon" onclick="toggleRow(this.parentElement.parentElement, this)" style="cursor:pointer;">[-]</span></td>
-                        {file_path_td}
-                        <td class='twenty'>
-                            {get_file_properties_table(file_path1)}
-                            {'<br>'.join(diff1)}
-                        </td>
-                        <td class='twenty'>
-                            {get_file_properties_table(file_path2)}
-                            {'<br>'.join(diff2)}
-                        </td>
-                    </tr>
-                    """)
-
-    for root2, dirs2, files2 in os.walk(dir2):
-        root1 = root2.replace(dir2, dir1)
-        for file2 in files2:
-            file1 = file2
-            file_path1 = os.path.join(root1, file1)
-            file_path2 = os.path.join(root2, file2)
-
-            file_path_td = generate_file_path_td(dir1, file_path1, dir2, file_path2, file_tags_dict)
-
-            if not os.path.exists(file_path1):
-                stats['added'] += 1
-                table_rows.append(f"<tr class='file-added'><td class='small'></td>{file_path_td}<td class='twenty' colspan='2' style='text-align: center;'><span>Added in '{dir2}'</span></td></tr>")
-
-    table_footer = "</tbody></table>"
-
-    stats['total'] = stats['identical'] + stats['changed'] + stats['added'] + stats['removed'] + stats['ignored']
-    stats_div = f"""
-        <div id="stats-div" style="display: flex; justify-content: space-around; align-items: center; margin: 10px 0px; padding: 0.75rem; border: solid 2px black;">
-            <div style='padding: 10px; font-weight: bold; text-align: center;' id="visible-rows-stat" data-total="{stats['total']}">Total: {stats['total']}</div>
-            <button onclick="onfilterByStats(this, 'file-changed')" class='stats-button file-changed'>Text changed: {stats['changed']}</button>
-            <button onclick="onfilterByStats(this, 'file-ignored')" class='stats-button file-ignored'>Hash changed: {stats['ignored']}</button>
-            <button onclick="onfilterByStats(this, 'file-added')" class='stats-button file-added'>Added: {stats['added']}</button>
-            <button onclick="onfilterByStats(this, 'file-removed')" class='stats-button file-removed'>Removed: {stats['removed']}</button>
-            <button onclick="onfilterByStats(this, 'file-no-change')" class='stats-button file-no-change'>Identical: {stats['identical']}</button>
-        </div>
-    """
+    table_footer = "</tbody></table></template>"
 
     script_tag = """
         <script>
@@ -450,72 +2242,165 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
                 return activeClasses;
             }
 
-            function getFilePathFromTableRow(tr) {
-                const [expCollapseTd, filePathTd] = tr.getElementsByTagName('td');
-                if (filePathTd) {
-                    const [filePathSpan] = filePathTd.getElementsByTagName('span');
-                    return filePathSpan.textContent || filePathSpan.innerText;
-                }
-                return '';
+            // rows live in an inert <template> and only the ones in view are moved into the table,
+            // filtering works on the precomputed rowIndex (paths, status classes and tags) with bitsets
+            const comparisonTable = document.getElementById('comparisonTable');
+            const visibleRowsBody = comparisonTable.tBodies[0];
+            const allRows = Array.from(document.getElementById('comparisonRows').content.querySelector('tbody').rows);
+            const rowCount = allRows.length;
+            const bitsetWords = (rowCount + 31) >>> 5;
+            const rowPathsUpper = rowIndex.paths.map(path => path.toUpperCase());
+            const rowHeights = new Float64Array(rowCount).fill(32);
+            allRows.forEach((row, i) => { row.rowIndexPosition = i; });
+
+            function buildBitsets(names, rowValues) {
+                const bitsets = {};
+                names.forEach(name => { bitsets[name] = new Uint32Array(bitsetWords); });
+                rowValues.forEach((values, i) => values.forEach(value => { bitsets[names[value]][i >>> 5] |= 1 << (i & 31); }));
+                return bitsets;
             }
+            const statusBitsets = buildBitsets(rowIndex.classes, rowIndex.status.map(status => [status]));
+            const tagBitsets = buildBitsets(rowIndex.tagNames, rowIndex.tags);
 
-            function shouldShowRow(tr, activeStats, activeTags) {
-                const showByStatsFilter = activeStats.length > 0 ? activeStats.includes(tr.classList[0]): true;
-
-                const [expCollapseTd, filePathTd] = tr.getElementsByTagName('td');
-                const [, ...tagsSpanList] = filePathTd.getElementsByTagName('span');
-                const rowTags = tagsSpanList.map(span => span.textContent);
-                const showByTagsFilter = activeTags.length > 0 ? activeTags.some(tag => rowTags.includes(tag)): true;
-
-                return showByStatsFilter && showByTagsFilter;
+            function unionBitset(bitsets, names) {
+                if (names.length === 0) {
+                    return null;
+                }
+                const result = new Uint32Array(bitsetWords);
+                names.forEach(name => {
+                    const bitset = bitsets[name];
+                    if (bitset) {
+                        for (let w = 0; w < bitsetWords; w++) {
+                            result[w] |= bitset[w];
+                        }
+                    }
+                });
+                return result;
             }
 
-            function updateSuggestions(value, activeStats, activeTags) {
-                let dataList = document.getElementById('filePaths');
-                dataList.innerHTML = '';
-                let table = document.getElementById('comparisonTable');
-                let tr = document.querySelectorAll('#comparisonTable > tbody > tr');
-                
-                for (let i = 0; i < tr.length; i++) {
-                    const showRowByFilter = shouldShowRow(tr[i], activeStats, activeTags)
-
-                    let txtValue = getFilePathFromTableRow(tr[i]);
-                    if (showRowByFilter && txtValue.toUpperCase().includes(value.toUpperCase())) {
-                        let option = document.createElement('option');
-                        option.value = txtValue.trim();
-                        dataList.appendChild(option);
-                    }
+            let filteredRows = [];
+            function updateSuggestions(value) {
+                let options = [];
+                for (let k = 0; k < filteredRows.length && options.length < 50; k++) {
+                    let option = document.createElement('option');
+                    option.value = rowIndex.paths[filteredRows[k]];
+                    options.push(option);
                 }
+                document.getElementById('filePaths').replaceChildren(...options);
             }
             function filterRows() {
                 let input = document.getElementById('searchInput');
                 let filterText = input.value.toUpperCase();
-                let activeStats = getActiveStats();
-                let activeTags = getActiveTags();
-
-                let tr = document.querySelectorAll('#comparisonTable > tbody > tr');
-                let visibleRowCount = 0;
-                for (let i = 0; i < tr.length; i++) {
-                
-                    const showRowByFilter = shouldShowRow(tr[i], activeStats, activeTags)
+                const activeBitsets = [unionBitset(statusBitsets, getActiveStats()), unionBitset(tagBitsets, getActiveTags())].filter(bitset => bitset);
+                let mask = null;
+                if (activeBitsets.length > 0) {
+                    mask = activeBitsets[0].slice();
+                    activeBitsets.slice(1).forEach(bitset => {
+                        for (let w = 0; w < bitsetWords; w++) {
+                            mask[w] &= bitset[w];
+                        }
+                    });
+                }
 
-                    let txtValue = getFilePathFromTableRow(tr[i]);
-                    if (showRowByFilter && txtValue.toUpperCase().indexOf(filterText) > -1) {
-                        tr[i].style.display = '';
-                        visibleRowCount++;
-                    } else {
-                        tr[i].style.display = 'none';
+                filteredRows = [];
+                for (let i = 0; i < rowCount; i++) {
+                    if (mask) {
+                        const word = mask[i >>> 5];
+                        if (word === 0) {
+                            i |= 31;
+                            continue;
+                        }
+                        if (!(word & (1 << (i & 31)))) {
+                            continue;
+                        }
+                    }
+                    if (filterText && !rowPathsUpper[i].includes(filterText)) {
+                        continue;
                     }
+                    filteredRows.push(i);
                 }
 
                 if (input.value.length >= 3) {
-                    updateSuggestions(input.value, activeStats, activeTags);
+                    updateSuggestions(input.value);
                 }
 
                 let visibleRowsStat = document.getElementById('visible-rows-stat');
                 const totalRows = visibleRowsStat.getAttribute('data-total');
+                const visibleRowCount = filteredRows.length;
                 visibleRowsStat.innerHTML = totalRows === visibleRowCount.toString() ? `Total: ${totalRows}` : `Total: ${totalRows} | Visible: ${visibleRowCount}`;
+                renderVisibleRows();
+            }
+            let filterTimer = null;
+            function scheduleFilterRows() {
+                clearTimeout(filterTimer);
+                filterTimer = setTimeout(filterRows, 150);
+            }
+
+            function createSpacerRow() {
+                let row = document.createElement('tr');
+                let cell = document.createElement('td');
+                cell.colSpan = 4;
+                cell.style.cssText = 'padding: 0; border: none; height: 0px';
+                row.appendChild(cell);
+                return row;
+            }
+            const topSpacerRow = createSpacerRow();
+            const bottomSpacerRow = createSpacerRow();
+            let renderedRows = [];
+            let renderScheduled = false;
+            function scheduleRenderVisibleRows() {
+                if (!renderScheduled) {
+                    renderScheduled = true;
+                    requestAnimationFrame(() => {
+                        renderScheduled = false;
+                        renderVisibleRows();
+                    });
+                }
+            }
+            function measureRenderedRows() {
+                let changed = false;
+                renderedRows.forEach(row => {
+                    const height = row.offsetHeight;
+                    if (height && height !== rowHeights[row.rowIndexPosition]) {
+                        rowHeights[row.rowIndexPosition] = height;
+                        changed = true;
+                    }
+                });
+                return changed;
+            }
+            function renderVisibleRows() {
+                measureRenderedRows();
+                const overscan = window.innerHeight;
+                const bodyTop = comparisonTable.getBoundingClientRect().top + window.scrollY + comparisonTable.tHead.offsetHeight;
+                const viewTop = window.scrollY - bodyTop - overscan;
+                const viewBottom = window.scrollY + window.innerHeight - bodyTop + overscan;
+
+                let first = 0, top = 0;
+                while (first < filteredRows.length && top + rowHeights[filteredRows[first]] < viewTop) {
+                    top += rowHeights[filteredRows[first]];
+                    first++;
+                }
+                let last = first, bottom = top;
+                while (last < filteredRows.length && bottom < viewBottom) {
+                    bottom += rowHeights[filteredRows[last]];
+                    last++;
+                }
+                let total = bottom;
+                for (let k = last; k < filteredRows.length; k++) {
+                    total += rowHeights[filteredRows[k]];
+                }
+
+                renderedRows = filteredRows.slice(first, last).map(i => allRows[i]);
+                topSpacerRow.cells[0].style.height = `${top}px`;
+                bottomSpacerRow.cells[0].style.height = `${total - bottom}px`;
+                visibleRowsBody.replaceChildren(topSpacerRow, ...renderedRows, bottomSpacerRow);
+                if (measureRenderedRows()) {
+                    scheduleRenderVisibleRows();
+                }
             }
+            window.addEventListener('scroll', scheduleRenderVisibleRows);
+            window.addEventListener('resize', scheduleRenderVisibleRows);
+
             function onfilterByStats($this, className) {
                 $this.classList.toggle('active')
                 filterRows()
@@ -527,7 +2412,32 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
                 filterRows()
             }
 
+            const diffShardCallbacks = {};
+            function registerDiffShard(shardId, cells) {
+                const callback = diffShardCallbacks[shardId];
+                delete diffShardCallbacks[shardId];
+                if (callback) {
+                    callback(cells);
+                }
+            }
+            function loadDiffShard(row, callback) {
+                const shardId = row.getAttribute('data-shard-id');
+                diffShardCallbacks[shardId] = cells => {
+                    row.cells[2].innerHTML = cells[0];
+                    row.cells[3].innerHTML = cells[1];
+                    row.setAttribute('data-shard-loaded', 'true');
+                    callback();
+                };
+                let script = document.createElement('script');
+                script.src = row.getAttribute('data-shard');
+                document.head.appendChild(script);
+            }
+
             function toggleRow(row, span) {
+                if (row.hasAttribute('data-shard') && !row.hasAttribute('data-shard-loaded')) {
+                    loadDiffShard(row, () => toggleRow(row, span));
+                    return;
+                }
                 let cells = row.getElementsByTagName('td');
                 for (let i = 2; i < cells.length; i++) {
                     if (cells[i].style.display === 'none') {
@@ -538,10 +2448,10 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
                         span.innerHTML = '[+]';
                     }    
                 }
+                scheduleRenderVisibleRows();
             }
             function expandAll() {
-                let table = document.getElementById('comparisonTable');
-                let tr = table.getElementsByTagName('tr');
+                let tr = allRows;
 
                 for (let i = 0; i < tr.length; i++) {
                     let icon = tr[i].getElementsByClassName('collapse-icon')[0];
@@ -555,8 +2465,7 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
             }
 
             function collapseAll() {
-                let table = document.getElementById('comparisonTable');
-                let tr = table.getElementsByTagName('tr');
+                let tr = allRows;
 
                 for (let i = 0; i < tr.length; i++) {
                     let icon = tr[i].getElementsByClassName('collapse-icon')[0];
@@ -568,10 +2477,39 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
                     }
                 }
             }
+
+            filterRows();
         </script>
     """
 
-    html_output = f"""
+    # a manifest file given in place of a directory provides the digests of that side
+    manifests = dict(manifests or {})
+    for directory in (dir1, dir2):
+        if is_manifest_file(directory):
+            manifests[directory] = load_manifest(directory).digests
+
+    cache = DigestCache(cache_dir, cache_size) if cache_dir else None
+    if manifests:
+        cache = ManifestDigestCache(manifests, cache)
+    # rows of paths whose files did not change since the last run are reused from the state file
+    state = ComparisonState(state_file, dir1, dir2, ignore_file_extensions, render_options) if state_file else None
+    global active_profiler
+    profiler = active_profiler = Profiler(profile_top) if profile else None
+    try:
+        with open_report(output_file) as f:
+            def write(data):
+                if profiler is not None:
+                    st = time.perf_counter()
+                    f.write(data)
+                    profiler.add_phase('write', time.perf_counter() - st)
+                else:
+                    f.write(data)
+
+            if output_format == 'json':
+                # streamed like ndjson, the stats are only known once all files are written
+                f.write(f'{{"dir1": {json.dumps(dir1)}, "dir2": {json.dumps(dir2)}, "files": [')
+            if output_format == 'html':
+                f.write(f"""
         <!DOCTYPE html>
         <html lang="en">
             <head>
@@ -582,20 +2520,91 @@ def compare_dirs(dir1, dir2, output_file, ignore_file_extensions=[], nlines=3, t
             </head>
             <body>
                 <h1 style='text-align: center; width: 100%;'>Directory Comparison Report</h1>
-                {stats_div}
+                <div id="stats-placeholder"></div>
                 {tags_filter_div}
                 <hr>
                 {table_header}
-                {''.join(table_rows)}
-                {table_footer}
-                {script_tag}
-            </body>
-        </html>
-    """
-
-    with open(output_file, 'w') as f:
-        f.write(html_output)
-
+            """)
+
+            # rows are written as soon as they are produced, so memory does not grow with the report.
+            # Only the small per-row index used by the search and filters is kept.
+            row_index = {'paths': [], 'status': [], 'tags': [], 'classes': list(STATUS_CLASSES.values()), 'tagNames': sorted(all_tags)}
+            status_positions = {status: i for i, status in enumerate(STATUS_CLASSES)}
+            tag_positions = {tag: i for i, tag in enumerate(row_index['tagNames'])}
+            record_separator = '\n'
+            def write_row(relative_file_path, status, row, tagged_file_path=None):
+                stats[status] += 1
+                if output_format == 'ndjson':
+                    write(row + '\n')
+                    return
+                if output_format == 'json':
+                    nonlocal record_separator
+                    write(record_separator + row)
+                    record_separator = ',\n'
+                    return
+                write(row)
+                row_index['paths'].append(relative_file_path)
+                row_index['status'].append(status_positions[status])
+                row_index['tags'].append([tag_positions[tag] for tag in lookup_file_tags(tagged_file_path or relative_file_path, file_tags_index)])
+
+            unmatched = {'removed': [], 'added': []}
+            for pair, status, row in compare_file_pairs(dir1, dir2, file_tags_index, ignore_file_extensions, jobs, cache, render_options, state, profiler, classify_jobs, diff_jobs, queue_size, path_filter):
+                if detect_moves and status in unmatched:
+                    # held back until the walk is done, they may turn out to be one moved file
+                    unmatched[status].append((pair, row))
+                    continue
+                write_row(os.path.normpath(os.path.relpath(pair[0], dir1)), status, row)
+            if detect_moves:
+                for row_args in match_moved_files(unmatched['removed'], unmatched['added'], dir1, dir2, file_tags_index, cache, render_options, move_similarity):
+                    write_row(*row_args)
+            stats['total'] = stats['identical'] + stats['changed'] + stats['added'] + stats['removed'] + stats['ignored'] + stats['moved']
+            if path_filter is not None:
+                stats['excluded_files'] = path_filter.excluded_files
+                stats['excluded_dirs'] = path_filter.excluded_dirs
+            if output_format == 'ndjson':
+                f.write(json.dumps({'stats': stats}) + '\n')
+            elif output_format == 'json':
+                f.write(f'\n], "stats": {json.dumps(stats)}}}\n')
+            else:
+                f.write(table_footer)
+                row_index_json = json.dumps(row_index, separators=(',', ':')).replace('</', '<\\/')
+                moved_button = f"""<button onclick="onfilterByStats(this, 'file-moved')" class='stats-button file-moved'>Moved: {stats['moved']}</button>""" if detect_moves else ''
+                excluded_div = f"""<div style='padding: 10px; text-align: center;' id="excluded-stat">Excluded: {path_filter.excluded_files} files, {path_filter.excluded_dirs} directories</div>""" if path_filter is not None else ''
+                stats_div = f"""
+                    <div id="stats-div" style="display: flex; flex-wrap: wrap; justify-content: space-around; align-items: center; margin: 10px 0px; padding: 0.75rem; border: solid 2px black;">
+                        <div style='padding: 10px; font-weight: bold; text-align: center;' id="visible-rows-stat" data-total="{stats['total']}">Total: {stats['total']}</div>
+                        <button onclick="onfilterByStats(this, 'file-changed')" class='stats-button file-changed'>Text changed: {stats['changed']}</button>
+                        <button onclick="onfilterByStats(this, 'file-ignored')" class='stats-button file-ignored'>Hash changed: {stats['ignored']}</button>
+                        <button onclick="onfilterByStats(this, 'file-added')" class='stats-button file-added'>Added: {stats['added']}</button>
+                        <button onclick="onfilterByStats(this, 'file-removed')" class='stats-button file-removed'>Removed: {stats['removed']}</button>
+                        <button onclick="onfilterByStats(this, 'file-no-change')" class='stats-button file-no-change'>Identical: {stats['identical']}</button>
+                        {moved_button}
+                        {excluded_div}
+                        {profiler.summary_html() if profiler is not None else ''}
+                    </div>
+                """
+
+                # the stats are only known once all rows are written, move them back above the table
+                f.write(f"""
+                    {stats_div}
+                    <script>document.getElementById('stats-placeholder').replaceWith(document.getElementById('stats-div'));</script>
+                    <script>const rowIndex = {row_index_json};</script>
+                    {script_tag}
+                </body>
+            </html>
+                """)
+    finally:
+        active_profiler = None
+        if cache is not None:
+            cache.close()
+        if state is not None:
+            state.close()
+
+    if profiler is not None:
+        # e.g. report.html -> report.profile.json, or differences.profile.json for stdout
+        profile_file = os.path.splitext(strip_compression_suffix(output_file))[0] if output_file != '-' else 'differences'
+        with open(profile_file + '.profile.json', 'w') as f:
+            json.dump(profiler.to_dict(), f, indent=2)
     return stats
 
 def create_index_html(html_files, index):
@@ -608,7 +2617,7 @@ def create_index_html(html_files, index):
             <body>
                 <h1>Directory Comparison Index</h1>
                 <hr>
-                <div>Legend: C - Total, T - Text changed, H - Hash changed, A - Added, R - Removed, I - Identical</div>
+                <div>Legend: C - Total, T - Text changed, H - Hash changed, A - Added, R - Removed, I - Identical, M - Moved</div>
                 <br>
                 <table border="1">
                     <tr>
@@ -653,6 +2662,7 @@ def create_index_html(html_files, index):
                                 <div style='width: 50px; text-align: center'>A: {stats['added']}</div>
                                 <div style='width: 50px; text-align: center'>R: {stats['removed']}</div>
                                 <div style='width: 50px; text-align: center'>I: {stats['identical']}</div>
+                                <div style='width: 50px; text-align: center'>M: {stats.get('moved', 0)}</div>
                             </div>
                         </td>
                         <td><a href="{output}">{output}</a></td>
@@ -685,8 +2695,16 @@ def process_tags_csv(csv_file):
                 tag_files_dict[tag] = [file_path]
     return tag_files_dict
 
-def process_csv(csv_file, ignore_file_extensions=[], nlines=3, index='differences_index.html'):
-    html_files = []
+def compare_csv_row(dir1, dir2, output, tags_csv, compare_options, manifests={}):
+    # get the start time
+    st = time.time()
+    stats = compare_dirs(dir1, dir2, output, tags_csv=tags_csv, manifests=manifests, **compare_options)
+    # get the execution time
+    return stats, time.time() - st
+
+def process_csv(csv_file, ignore_file_extensions=[], nlines=3, index='differences_index.html', jobs=1, cache_dir='', cache_size=1000000, parallel_jobs=1, **compare_options):
+    """Compare every row of `csv_file`, extra `compare_options` are passed on to compare_dirs."""
+    rows = []
     with open(csv_file, newline='') as csvfile:
         csv_reader = csv.reader(csvfile)
         next(csv_reader)  # Skip the first row (labels)
@@ -699,17 +2717,60 @@ def process_csv(csv_file, ignore_file_extensions=[], nlines=3, index='difference
 
             if not dir1 or not dir2 or not output:
                 raise ValueError('Invalid CSV format. dir1, dir2 and output are required')
-            
+            rows.append((dir1, dir2, output, group, tags_csv))
+
+    compare_options = {
+        **compare_options,
+        'ignore_file_extensions': ignore_file_extensions,
+        'nlines': nlines,
+        # --jobs is the budget for the whole batch, shared by the rows running at the same time
+        'jobs': max(1, jobs // parallel_jobs),
+        'cache_dir': cache_dir,
+        'cache_size': cache_size,
+    }
+
+    # directories used by several rows (typically a baseline compared against many builds)
+    # are walked and hashed once, and every row then reuses that manifest
+    directory_rows = {}
+    for dir1, dir2, output, group, tags_csv in rows:
+        for directory in {os.path.normpath(dir1), os.path.normpath(dir2)}:
+            directory_rows[directory] = directory_rows.get(directory, 0) + 1
+    manifests = {}
+    cache = DigestCache(cache_dir, cache_size) if cache_dir else None
+    try:
+        for directory, row_count in directory_rows.items():
+            if row_count > 1 and os.path.isdir(directory):
+                print(f'Building shared manifest for {directory} ({row_count} rows)')
+                # excluded subtrees of the shared directory are not walked or hashed either
+                path_filter = create_path_filter(directory, None, compare_options.get('include', ()), compare_options.get('exclude', ()), compare_options.get('ignore_file', ''))
+                manifests[directory] = build_manifest(directory, cache, jobs, path_filter)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    def row_manifests(dir1, dir2):
+        # only the manifests of the row's own directories, each submitted row pickles what it is given
+        return {directory: manifests[directory] for directory in (os.path.normpath(dir1), os.path.normpath(dir2)) if directory in manifests}
+
+    row_stats = {}
+    if parallel_jobs > 1:
+        with ProcessPoolExecutor(max_workers=parallel_jobs) as pool:
+            futures = {}
+            for i, (dir1, dir2, output, group, tags_csv) in enumerate(rows):
+                print(f'Comparing {dir1} and {dir2} and generating {output}')
+                futures[pool.submit(compare_csv_row, dir1, dir2, output, tags_csv, compare_options, row_manifests(dir1, dir2))] = i
+            for future in as_completed(futures):
+                i = futures[future]
+                row_stats[i], elapsed_time = future.result()
+                print(f'Execution time for {rows[i][2]}:', elapsed_time, 'seconds')
+    else:
+        for i, (dir1, dir2, output, group, tags_csv) in enumerate(rows):
             print(f'Comparing {dir1} and {dir2} and generating {output}')
-            # get the start time
-            st = time.time()
-            stats = compare_dirs(dir1, dir2, output, ignore_file_extensions, nlines, tags_csv)
-            # get the end time
-            et = time.time()
-            # get the execution time
-            elapsed_time = et - st
+            row_stats[i], elapsed_time = compare_csv_row(dir1, dir2, output, tags_csv, compare_options, row_manifests(dir1, dir2))
             print(f'Execution time for {output}:', elapsed_time, 'seconds')
-            html_files.append((dir1, dir2, stats, output, group, tags_csv))
+
+    # the index keeps the CSV order, whichever row finished first
+    html_files = [(dir1, dir2, row_stats[i], output, group, tags_csv) for i, (dir1, dir2, output, group, tags_csv) in enumerate(rows)]
     create_index_html(html_files, index)
 
 if __name__ == "__main__":
@@ -720,6 +2781,11 @@ if __name__ == "__main__":
     python compare_directories.py path/to/first/directory path/to/second/directory --hash war jar --tags-csv path/to/tags_csv1.csv -n 3 -o my_differences.html
         (or)
     python compare_directories.py --csv path/to/csv_file.csv --hash war jar -n 3 --index differences_index.html
+        (or, to snapshot a directory and later compare against the snapshot)
+    python compare_directories.py path/to/first/directory --write-manifest release.manifest
+    python compare_directories.py release.manifest path/to/second/directory -o my_differences.html
+        (or, to stream one JSON record per file to stdout instead of writing a report)
+    python compare_directories.py path/to/first/directory path/to/second/directory --format ndjson -o -
     ------------------------------------
     CSV Format:
     dir1,dir2,output,group,tags_csv
@@ -729,31 +2795,72 @@ if __name__ == "__main__":
     tag,file_path
     tag1,path/to/file1
     tag2,path/to/file2
+    tag3,path/to/dir/
+    tag4,*.properties
+    (a trailing / tags everything below a directory, *, ? and [...] are glob patterns)
     '''
     )
     parser.add_argument('--csv', help='Path to the CSV file containing multiple sets of arguments.')
     parser.add_argument('--index', default='differences_index.html', help='Path to the output file (default: differences_index.html).')
-    parser.add_argument('dir1', nargs='?', help='Path to the first directory.')
-    parser.add_argument('dir2', nargs='?', help='Path to the second directory.')
-    parser.add_argument('-o', '--output', default='differences.html', help='Path to the output file (default: differences.html).')
+    parser.add_argument('--parallel-jobs', type=int, default=1, help='Number of CSV rows compared at the same time, --jobs is shared between them (default: 1).')
+    parser.add_argument('dir1', nargs='?', help='Path to the first directory (or manifest file).')
+    parser.add_argument('dir2', nargs='?', help='Path to the second directory (or manifest file).')
+    parser.add_argument('-o', '--output', help='Path to the output file, - for stdout (default: differences.html, .ndjson or .json depending on --format). A name ending in .gz or .br writes a gzip or brotli compressed report.')
+    parser.add_argument('--format', dest='output_format', choices=['html', 'ndjson', 'json'], default='html', help='html writes the report, ndjson streams one JSON record per file (path, status, sizes, known MD5 hashes) as it is compared followed by a {"stats": ...} line, json writes the same records as {"dir1", "dir2", "files", "stats"}. ndjson and json do not render any html (default: html).')
+    parser.add_argument('--record-diffs', action='store_true', help='With --format ndjson or json, add the unified diff text of changed files to their records, within the --max-diff-* budgets (default: off).')
     parser.add_argument('--hash', nargs='+', default=['war', 'jar', 'jks'], help='List of file extensions to do MD5 Hash Compare (default: war jar jks).')
     parser.add_argument('--tags-csv', default='', help='CSV File containing list of tags for matching file paths (default: '').')
     parser.add_argument('-n', '--nlines', type=int, default=3, help='Number of unchanged lines to show above and below diff (default: 3).')
+    parser.add_argument('--diff-algorithm', choices=DIFF_MATCHERS.keys(), default='difflib', help='Line diff algorithm, myers/patience/histogram are much faster on large files (default: difflib).')
+    parser.add_argument('--intraline-max-lines', type=int, default=200, help='Replaced blocks with more lines than this are shown as plain removed/added lines without character level highlighting (default: 200).')
+    parser.add_argument('--report-mode', choices=['inline', 'sharded'], default='inline', help='inline embeds every diff in the report, sharded writes each diff to a <output>_files/ fragment loaded when its row is expanded (default: inline).')
+    parser.add_argument('--max-diff-bytes', type=int, default=0, help='Changed files larger than this many bytes together are shown as a "diff truncated" summary with sizes, hashes and line counts instead of a diff, 0 for no limit (default: 0).')
+    parser.add_argument('--max-diff-lines', type=int, default=0, help='Same for changed files with more than this many lines together, 0 for no limit (default: 0).')
+    parser.add_argument('--diff-timeout', type=float, default=0, help='Seconds a single diff may take before it is truncated the same way, checked inside line matching and intraline highlighting, 0 for no limit (default: 0).')
+    parser.add_argument('--no-archive-members', dest='archive_members', action='store_false', help='Only compare the MD5 hash of zip/jar/war/ear files given in --hash, instead of listing their changed members (default: members are compared).')
+    parser.add_argument('--detect-moves', action='store_true', help='Pair removed and added files with the same content into "moved" rows, instead of one removed and one added row (default: off).')
+    parser.add_argument('--move-similarity', type=float, default=0, help='With --detect-moves, also pair text files whose estimated line similarity is at least this (0-1), shown with their diff, 0 for exact moves only (default: 0).')
+    parser.add_argument('--include', nargs='+', default=[], help='Only compare files matching one of these globs, or below a directory matching one. A glob without / matches names at any depth, with / the path from the root, a trailing / only directories (default: all files).')
+    parser.add_argument('--exclude', nargs='+', default=[], help='Skip files and directories matching one of these globs (same syntax as --include), excluded directories are not walked at all, e.g. --exclude .git/ node_modules/ "*.log" (default: none).')
+    parser.add_argument('--ignore-file', default='', help='File with one --exclude glob per line (# comments allowed) (default: .compareignore in the root of dir1 or dir2, if present).')
+    parser.add_argument('--write-manifest', metavar='MANIFEST', help='Write a snapshot manifest of dir1 to this file instead of comparing. A manifest can later be given in place of dir1 or dir2.')
+    parser.add_argument('--manifest-max-content-size', type=int, default=1024 * 1024, help='Text files up to this many bytes keep their compressed content in the manifest so they can be diffed, 0 to store only hashes (default: 1048576).')
+    parser.add_argument('--cache-dir', default='', help='Directory for a persistent file digest cache, so unchanged files are not re-read across runs (default: no cache).')
+    parser.add_argument('--cache-size', type=int, default=1000000, help='Maximum number of file digests kept in the cache, least recently used are evicted (default: 1000000).')
+    parser.add_argument('--state-file', default='', help='SQLite file keeping the rows of previous runs, only paths whose files changed since then are compared again (default: no state).')
+    parser.add_argument('--profile', action='store_true', help='Record per-phase timings, bytes read, time per file and the slowest diffs, written to <output>.profile.json and shown in the report (default: off).')
+    parser.add_argument('--profile-top', type=int, default=10, help='Number of slowest diffs kept by --profile (default: 10).')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of workers used to compare and diff file pairs in parallel (default: 1).')
+    parser.add_argument('--classify-jobs', type=int, default=0, help='With --jobs > 1, threads comparing and hashing files (default: --jobs).')
+    parser.add_argument('--diff-jobs', type=int, default=0, help='With --jobs > 1, processes diffing changed files (default: --jobs).')
+    parser.add_argument('--queue-size', type=int, default=0, help='With --jobs > 1, maximum number of file pairs in flight between the pipeline stages (default: 4 * --jobs).')
 
     args = parser.parse_args()
+    args.output = args.output or f'differences.{args.output_format}'
+    # keep stdout clean for the records written to it
+    log_file = sys.stderr if args.output == '-' else sys.stdout
 
     # get the start time
     tst = time.time()
 
-    if args.csv:
-        process_csv(args.csv, args.hash, args.nlines, args.index)
+    if args.write_manifest:
+        if not args.dir1:
+            parser.error("Following arguments are required: dir1")
+        cache = DigestCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+        path_filter = create_path_filter(os.path.normpath(args.dir1), None, args.include, args.exclude, args.ignore_file)
+        file_count = write_manifest(args.dir1, args.write_manifest, args.hash, args.manifest_max_content_size, cache, args.jobs, path_filter)
+        if cache is not None:
+            cache.close()
+        print(f'Wrote manifest of {file_count} files from {args.dir1} to {args.write_manifest}')
+    elif args.csv:
+        process_csv(args.csv, args.hash, args.nlines, args.index, args.jobs, args.cache_dir, args.cache_size, args.parallel_jobs, diff_algorithm=args.diff_algorithm, intraline_max_lines=args.intraline_max_lines, report_mode=args.report_mode, state_file=args.state_file, profile=args.profile, profile_top=args.profile_top, max_diff_bytes=args.max_diff_bytes, max_diff_lines=args.max_diff_lines, diff_timeout=args.diff_timeout, archive_members=args.archive_members, detect_moves=args.detect_moves, move_similarity=args.move_similarity, classify_jobs=args.classify_jobs, diff_jobs=args.diff_jobs, queue_size=args.queue_size, include=args.include, exclude=args.exclude, ignore_file=args.ignore_file, output_format=args.output_format, record_diffs=args.record_diffs)
     else:
         if not args.dir1 or not args.dir2:
             parser.error("Following arguments are required: dir1, dir2")
-        stats = compare_dirs(args.dir1, args.dir2, args.output, ignore_file_extensions=args.hash, nlines=args.nlines, tags_csv=args.tags_csv)
-        print(stats)
+        stats = compare_dirs(args.dir1, args.dir2, args.output, ignore_file_extensions=args.hash, nlines=args.nlines, tags_csv=args.tags_csv, jobs=args.jobs, cache_dir=args.cache_dir, cache_size=args.cache_size, diff_algorithm=args.diff_algorithm, intraline_max_lines=args.intraline_max_lines, report_mode=args.report_mode, state_file=args.state_file, profile=args.profile, profile_top=args.profile_top, max_diff_bytes=args.max_diff_bytes, max_diff_lines=args.max_diff_lines, diff_timeout=args.diff_timeout, archive_members=args.archive_members, detect_moves=args.detect_moves, move_similarity=args.move_similarity, classify_jobs=args.classify_jobs, diff_jobs=args.diff_jobs, queue_size=args.queue_size, include=args.include, exclude=args.exclude, ignore_file=args.ignore_file, output_format=args.output_format, record_diffs=args.record_diffs)
+        print(stats, file=log_file)
     # get the end time
     tet = time.time()
     # get the execution time
     total_elapsed_time = tet - tst
-    print('Total Execution time:', total_elapsed_time, 'seconds')
+    print('Total Execution time:', total_elapsed_time, 'seconds', file=log_file)